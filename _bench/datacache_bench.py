@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Times a data module's load() parsing a synthetic CSV against reading it back from
+a datacache snapshot, as each worker process would at startup.
+
+    python _bench/datacache_bench.py [--rows 1000000]
+
+Exits non-zero if the snapshot differs from what load() returns, or if it's still
+used after the CSV or the loader's module changes.
+"""
+import argparse
+import importlib
+import os
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from _util import datacache  # noqa: E402
+
+# Shaped like housing/df_snapshot.py
+MODULE = '''import pandas as pd
+
+from _util import datacache
+
+FILENAME = "bench_data/table.csv"
+
+
+@datacache.cached(FILENAME)
+def load():
+    df = pd.read_csv(FILENAME, parse_dates=["date"])
+    df["fips"] = df.fips.astype(str).str.zfill(2)
+    data = {"df": df, "keys": ["state", "fips"]}
+    data["types"] = {col: float for col in df.columns if col.startswith("value")}
+    return data
+'''
+
+
+def write_csv(path, rows) -> None:
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(0)
+    states = np.array(["CA", "NY", "TX", "WA", "FL", "OR", "NV", "AZ"])
+    pd.DataFrame(
+        {
+            "date": pd.date_range("2000-01-01", periods=rows, freq="min"),
+            "state": states[rng.integers(0, len(states), rows)],
+            "fips": rng.integers(1, 57, rows),
+            **{f"value{idx}": rng.normal(size=rows) for idx in range(6)},
+        }
+    ).to_csv(path, index=False)
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def same(left, right) -> bool:
+    rest = [key for key in left if key != "df"]
+    return left["df"].equals(right["df"]) and all(
+        left[key] == right[key] for key in rest
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=1000000, help="CSV rows")
+    args = parser.parse_args()
+    datacache.logging.setLevel("WARNING")
+
+    ok = True
+    with tempfile.TemporaryDirectory() as root:
+        os.chdir(root)
+        sys.path.insert(0, root)
+        os.makedirs("bench_data")
+        write_csv("bench_data/table.csv", args.rows)
+        with open("bench_data/loader.py", "w") as fh:
+            fh.write(MODULE)
+        module = importlib.import_module("bench_data.loader")
+        size = os.path.getsize("bench_data/table.csv") / 2 ** 20
+
+        parsed, parse_took = timed(module.load.uncached)
+        _, first_took = timed(module.load)
+        cached, cached_took = timed(module.load)
+        print(f"{args.rows} rows, {size:.0f} MB of CSV")
+        print(f"load():            {parse_took:7.3f}s")
+        print(f"first, with save:  {first_took:7.3f}s")
+        speedup = parse_took / cached_took
+        print(f"from snapshot:     {cached_took:7.3f}s ({speedup:.0f}x)")
+        if not same(parsed, cached):
+            print("Snapshot differs from load()")
+            ok = False
+
+        # A copied source (new mtime, same content) is rehashed but still current
+        os.utime("bench_data/table.csv")
+        _, rehash_took = timed(module.load)
+        print(f"touched source:    {rehash_took:7.3f}s (rehashed)")
+
+        # Changing the data, then the loader, must each bypass the snapshot
+        with open("bench_data/table.csv", "a") as fh:
+            fh.write("2100-01-01,CA,6,1,2,3,4,5,6\n")
+        if len(module.load()["df"]) != args.rows + 1:
+            print("Snapshot used after the source changed")
+            ok = False
+        meta_file = f"{datacache.CACHE_DIR}/bench_data.loader.load.json"
+        key = datacache._read_meta(meta_file)["key"]
+        with open("bench_data/loader.py", "a") as fh:
+            fh.write("\n# changed\n")
+        importlib.reload(module)
+        module.load()
+        if datacache._read_meta(meta_file)["key"] == key:
+            print("Snapshot used after the loader changed")
+            ok = False
+    sys.exit(0 if ok else 1)
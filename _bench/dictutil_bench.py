@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Checks dictutil.flatten/nest against their previous recursive versions and
+times both on wide and deep synthetic descriptor trees.
+
+    python _bench/dictutil_bench.py [--banks 20000] [--depth 1500]
+
+Exits non-zero if any result differs from the previous implementation, or if a
+flatten/nest round trip doesn't give back the original tree.
+"""
+import argparse
+import os
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from _util import dictutil  # noqa: E402
+
+
+def recursive_flatten(dict_in, delim="__", loc=[]):
+    """dictutil.flatten before it walked with a stack"""
+    loc = loc or []
+    output = {}
+    if not dict_in and loc:
+        output[delim.join(loc)] = {}
+    for key in dict_in:
+        if isinstance(dict_in[key], dict):
+            sub_loc = loc + [str(key)]
+            output.update(recursive_flatten(dict_in[key], delim=delim, loc=sub_loc))
+        else:
+            base_key = delim.join(loc + [str(key)])
+            output[base_key] = dict_in[key]
+    return output
+
+
+def recursive_nest(dict_in, delim="__"):
+    """dictutil.nest before it walked with a stack, with delim passed down (the
+    previous version reverted to "__" below the first level)
+    """
+    output, renest = {}, []
+    for key in dict_in:
+        if delim not in key:
+            output[key] = dict_in[key]
+            continue
+        loc = key.split(delim, 1)
+        if loc[0] not in output:
+            output[loc[0]] = {}
+            renest.append(loc[0])
+        output[loc[0]][loc[1]] = dict_in[key]
+    for renest_key in renest:
+        output[renest_key] = recursive_nest(output[renest_key], delim)
+    return output
+
+
+def wide_tree(banks) -> dict:
+    """A descriptor with many banks on a few pages, each with a few args"""
+    pages = {}
+    for idx in range(banks):
+        page = pages.setdefault(f"page{idx % 10}", {"banks": {}, "layout": []})
+        page["banks"][f"bank{idx}"] = {
+            "type": "graph",
+            "width": idx % 12,
+            "args": {"x": "date", "y": f"col{idx}", "options": {}},
+        }
+    return {"name": "wide", "pages": pages, "theme": {}}
+
+
+def deep_tree(depth) -> dict:
+    tree = {"leaf": 1, "empty": {}}
+    for level in range(depth):
+        tree = {f"level{level}": tree, f"value{level}": level}
+    return tree
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def check(label, tree, delim="__", compare=True) -> bool:
+    ok = True
+    flat, took = timed(dictutil.flatten, tree, delim)
+    nested, nest_took = timed(dictutil.nest, flat, delim)
+    streamed, stream_took = timed(
+        lambda: dictutil.nest(dictutil.iflatten(tree, delim), delim)
+    )
+    line = f"{label: <22} flatten {took:7.4f}s  nest {nest_took:7.4f}s"
+    line += f"  streamed {stream_took:7.4f}s"
+    if compare:
+        round_trips = nested == tree and streamed == tree
+    else:
+        # == on very deep dicts would itself hit the recursion limit, compare flat
+        round_trips = dictutil.flatten(nested) == flat == dictutil.flatten(streamed)
+    if not round_trips:
+        print(f"{label}: round trip changed the tree")
+        ok = False
+    if compare:
+        old_flat, old_took = timed(recursive_flatten, tree, delim)
+        old_nested, old_nest_took = timed(recursive_nest, old_flat, delim)
+        if old_flat != flat or list(old_flat) != list(flat):
+            print(f"{label}: flatten differs from the recursive version")
+            ok = False
+        if old_nested != nested:
+            print(f"{label}: nest differs from the recursive version")
+            ok = False
+        line += f"  (recursive: {old_took:7.4f}s, {old_nest_took:7.4f}s)"
+    print(line)
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--banks", type=int, default=20000, help="Wide tree banks")
+    parser.add_argument("--depth", type=int, default=1500, help="Deep tree depth")
+    args = parser.parse_args()
+
+    results = [
+        check("empty", {}),
+        check("empty leaves", {"a": {}, "b": {"c": {}, "d": 1}}),
+        check("custom delim", {"a": {"b": {"c": 1}}, "d": 2}, delim="."),
+        check("wide", wide_tree(args.banks)),
+        check("moderately deep", deep_tree(min(args.depth, 400))),
+        # Too deep for the recursive versions
+        check("deep", deep_tree(args.depth), compare=False),
+    ]
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Checks how long build.py spends importing modules, using python -X importtime,
+and fails when a path exceeds its budget. Heavy packages (docker, yaml, flask...)
+should only be imported by the steps that need them.
+
+    python _bench/import_budget.py [--help-ms 150] [--execute-ms 200]
+
+Modules an empty interpreter already imports at startup (site, encodings...) are
+left out, so only build.py's own imports count against the budget.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(args) -> dict:
+    """Cumulative import time in microseconds of each top-level import"""
+    cmd = [sys.executable, "-X", "importtime"] + args
+    proc = subprocess.run(cmd, cwd=REPO, capture_output=True, text=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # Nested imports are indented beneath the module importing them
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def check(label, args, budget_ms, startup, top=5) -> bool:
+    times = import_times(args)
+    own = {name: us for name, us in times.items() if name not in startup}
+    total_ms = sum(own.values()) / 1e3
+    ok = total_ms <= budget_ms
+    status = "ok  " if ok else "OVER"
+    print(f"{status} {label}: {total_ms:.1f} ms (budget {budget_ms:.0f} ms)")
+    for name, us in sorted(own.items(), key=lambda item: -item[1])[:top]:
+        print(f"       {us / 1e3:7.1f} ms  {name}")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--help-ms", type=float, default=150, help="Budget for --help (150)"
+    )
+    parser.add_argument(
+        "--execute-ms", type=float, default=200, help="Budget for -x (200)"
+    )
+    parser.add_argument(
+        "--app", type=str, default="simple_example", help="App for -x (simple_example)"
+    )
+    args = parser.parse_args()
+
+    startup = set(import_times(["-c", "pass"]))
+    with tempfile.TemporaryDirectory() as tmp:
+        # Runs the -x steps as usual, but with an entrypoint that exits at once
+        noop = os.path.join(tmp, "noop")
+        with open(f"{noop}.py", "w") as fh:
+            fh.write("")
+        results = [
+            check("build.py --help", ["build.py", "--help"], args.help_ms, startup),
+            check(
+                f"build.py {args.app} -x",
+                ["build.py", args.app, "-x", "--entrypoint", noop],
+                args.execute_ms,
+                startup,
+            ),
+        ]
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Measures what logutil.loginfo adds to each call of a decorated function while
+its level is disabled (the usual case in production), and fails above a budget.
+
+    python _bench/loginfo_bench.py [--budget-ns 500]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from _util import logutil  # noqa: E402
+
+
+def plain(a, b=2):
+    return a + b
+
+
+@logutil.loginfo(level="debug")
+def decorated(a, b=2):
+    return a + b
+
+
+@logutil.loginfo(level="debug", sample=100)
+def sampled(a, b=2):
+    return a + b
+
+
+def per_call_ns(func, number) -> float:
+    # Best of several repeats, the least disturbed by the rest of the system
+    best = min(timeit.repeat(lambda: func(1, b=3), number=number, repeat=7))
+    return best / number * 1e9
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--budget-ns", type=float, default=500, help="Allowed overhead (500 ns)"
+    )
+    parser.add_argument("-n", "--number", type=int, default=200000, help="Calls")
+    args = parser.parse_args()
+
+    logutil.logging.setLevel("INFO")
+    base = per_call_ns(plain, args.number)
+    disabled = per_call_ns(decorated, args.number) - base
+    print(f"undecorated call:       {base:8.0f} ns")
+    print(f"loginfo, disabled:     +{disabled:8.0f} ns")
+
+    # With the level enabled, 1 in 100 calls is logged (to a discarded stream)
+    logutil.logging.setLevel("DEBUG")
+    stream = logutil.logging.handlers[0]
+    stream.setStream(open(os.devnull, "w"))
+    enabled = per_call_ns(decorated, args.number // 100) - base
+    every_100 = per_call_ns(sampled, args.number // 10) - base
+    print(f"loginfo, enabled:      +{enabled:8.0f} ns")
+    print(f"loginfo, sample=100:   +{every_100:8.0f} ns")
+
+    ok = disabled <= args.budget_ns
+    print(f"{'ok' if ok else 'OVER'}: disabled overhead budget {args.budget_ns:.0f} ns")
+    sys.exit(0 if ok else 1)
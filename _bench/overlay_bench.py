@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Times materializing the compose config of every app and environment with the
+overlay module against parsing and merging each combination's files two at a time
+(as merge_yaml did, with the pure-Python loader and dictutil.merge).
+
+    python _bench/overlay_bench.py [--apps 20] [--services 30]
+
+Exits non-zero if the results differ, or if materializing modified cached layers.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from _util import dictutil, overlay  # noqa: E402
+
+ENVS = [None, "dev", "staging", "prod", "prod-eu", "prod-us"]
+
+
+def service(idx, env) -> dict:
+    """A compose service, with lists that don't overlap between layers"""
+    tag = env or "base"
+    return {
+        "image": f"registry/app{idx}:{tag}",
+        "environment": {f"{tag.upper()}_SETTING": str(idx), "SHARED": tag},
+        "volumes": [f"/data/{tag}/{idx}:/app/data/{tag}"],
+        "ports": [f"{8000 + idx}:{8000 + idx}"] if env is None else [],
+        "deploy": {"resources": {"limits": {"memory": f"{idx % 8 + 1}G"}}},
+    }
+
+
+def write_layers(root, apps, services) -> list:
+    os.makedirs(f"{root}/_docker")
+    for env in ENVS:
+        prefix = f"{env}-" if env else ""
+        svcs = {f"svc{idx}": service(idx, env) for idx in range(services)}
+        layer = {"services": svcs}
+        overlay.dump(layer, f"{root}/_docker/{prefix}{overlay.COMPOSE}")
+    names = []
+    for app_idx in range(apps):
+        app = f"app{app_idx}"
+        os.makedirs(f"{root}/{app}")
+        for env in (None, "prod"):
+            prefix = f"{env}-" if env else ""
+            layer = {"services": {"svc0": {"environment": {"APP": app}}}}
+            overlay.dump(layer, f"{root}/{app}/{prefix}{overlay.COMPOSE}")
+        names.append(app)
+    return names
+
+
+def pairwise(apps, envs) -> dict:
+    """Each combination parsed and merged from scratch"""
+    import yaml
+
+    configs = {}
+    for app in apps:
+        for env in envs:
+            paths = overlay.layer_paths(app, env)
+            with open(paths[0]) as fh:
+                merged = yaml.load(fh, Loader=yaml.Loader)
+            for path in paths[1:]:
+                with open(path) as fh:
+                    merged = dictutil.merge(merged, yaml.load(fh, Loader=yaml.Loader))
+            configs[(app, env)] = merged
+    return configs
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--apps", type=int, default=20, help="Apps")
+    parser.add_argument("--services", type=int, default=30, help="Services per layer")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        os.chdir(root)
+        apps = write_layers(root, args.apps, args.services)
+        combos = len(apps) * len(ENVS)
+        expected, old_took = timed(pairwise, apps, ENVS)
+        configs, cold = timed(overlay.materialize, apps, ENVS)
+        again, warm = timed(overlay.materialize, apps, ENVS)
+
+        # Mutating a result must not reach the cached layers behind the next one
+        configs[(apps[0], None)]["services"]["svc0"]["volumes"].append("leak")
+        unchanged = overlay.materialize(apps[:1], [None]) == {
+            (apps[0], None): expected[(apps[0], None)]
+        }
+        same = again == expected
+
+    print(f"{combos} configs from {len(overlay._docs)} files")
+    print(f"pairwise, pure-Python: {old_took:7.3f}s")
+    print(f"overlay, cold:         {cold:7.3f}s ({old_took / cold:.1f}x)")
+    print(f"overlay, cached:       {warm:7.3f}s ({old_took / warm:.1f}x)")
+    if not same:
+        print("Results differ from pairwise merging")
+    if not unchanged:
+        print("Modifying a result changed the cached layers")
+    sys.exit(0 if same and unchanged else 1)
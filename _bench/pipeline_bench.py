@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""Times the build steps that don't need Docker (staging, docker materials, the
+.env file, compose merging and context digesting) on synthetic apps of varying
+shape, so changes to file_management, versioning or staging can be measured.
+
+    python _bench/pipeline_bench.py -o bench.json
+    python _bench/pipeline_bench.py --compare bench.json
+
+Each scenario is generated in a temporary workspace, which build.py's steps see as
+the repo root. Results are the median and minimum of --repeat runs, in seconds.
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+# Keep the steps' logging out of the timings
+os.environ.setdefault("LOGLEVEL", "40")
+
+import build  # noqa: E402
+from _util import docker_context, environment, versioning  # noqa: E402
+from _util import file_management as FM  # noqa: E402
+
+# Shapes of synthetic app: counts are multiplied by --scale, sizes in bytes
+SCENARIOS = {
+    "small_files": {"apps": 1, "files": 2000, "file_size": 1024, "dirs": 20},
+    "huge_data": {"apps": 1, "files": 10, "data_files": 3, "data_size": 32 << 20},
+    "deep_tree": {"apps": 1, "files": 300, "depth": 12, "descriptor_depth": 40},
+    "many_apps": {"apps": 20, "files": 50, "file_size": 4096, "dirs": 5},
+}
+
+
+def _write(path, size, rng):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fh:
+        # Random bytes in 1 MB blocks, so big files don't need as much memory
+        while size > 0:
+            block = min(size, 1 << 20)
+            fh.write(rng.getrandbits(8 * block).to_bytes(block, "little"))
+            size -= block
+
+
+def _nested(depth, width=3) -> dict:
+    """A descriptor-like dict, depth levels deep with width keys at each level, of
+    which one leads to the next level
+    """
+    tree = {"type": "graph", "args": {"width": width}}
+    for level in range(depth):
+        banks = {f"bank_{level}_{idx}": {"type": "graph"} for idx in range(width)}
+        banks[f"bank_{level}_0"] = tree
+        banks["layout"] = [[f"bank_{level}_{idx}" for idx in range(width)]]
+        tree = banks
+    return tree
+
+
+def make_app(root, app, shape, scale, rng) -> None:
+    app_dir = os.path.join(root, app)
+    files = max(1, int(shape.get("files", 0) * scale))
+    dirs = shape.get("dirs", 1)
+    depth = shape.get("depth", 0)
+    for idx in range(files):
+        if depth:
+            parts = [f"level{level}" for level in range(idx % (depth + 1))]
+        else:
+            parts = [f"pkg{idx % dirs}"]
+        path = os.path.join(app_dir, *parts, f"module_{idx}.py")
+        _write(path, shape.get("file_size", 512), rng)
+    for idx in range(shape.get("data_files", 0)):
+        size = int(shape["data_size"] * scale)
+        _write(os.path.join(app_dir, f"table_{idx}.csv"), size, rng)
+    with open(os.path.join(app_dir, "_version.py"), "w") as fh:
+        fh.write('__version__ = "1.0.0"\n')
+    with open(os.path.join(app_dir, "descriptor.py"), "w") as fh:
+        tree = _nested(shape.get("descriptor_depth", 3))
+        fh.write(f"descriptor = {tree!r}\n")
+
+
+def make_workspace(name, shape, scale, seed=0) -> str:
+    """A temporary repo root holding the scenario's apps and the real _docker/ENV"""
+    root = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    shutil.copytree(os.path.join(REPO, "_docker"), os.path.join(root, "_docker"))
+    shutil.copy(os.path.join(REPO, "ENV"), root)
+    rng = random.Random(seed)
+    for idx in range(shape["apps"]):
+        make_app(root, f"bench_{name}_{idx}", shape, scale, rng)
+
+    # Compose files to merge, as deep as the scenario's descriptors
+    depth = shape.get("descriptor_depth", 3)
+    FM.dump({"services": {"bento": _nested(depth, width=2)}}, f"{root}/base.yaml")
+    FM.dump({"services": {"bento": _nested(depth, width=3)}}, f"{root}/over.yaml")
+    return root
+
+
+def app_args(app) -> argparse.Namespace:
+    """Build args as build.py's CLI would make them, with Docker steps left out"""
+    return argparse.Namespace(
+        app=app,
+        build_dir="_build",
+        stg_dir=f"_build/{app}",
+        entrypoint="entrypoint",
+        env=environment.ENV_SPEC(),
+        version="1.0.0",
+        clean=False,
+        dev=False,
+        stream=False,
+        execute=False,
+        buildkit=False,
+        verbose=False,
+    )
+
+
+def context_digest(args) -> str:
+    files = build.context_files(args)
+    known = FM.known_hashes(args.stg_dir)
+    return docker_context.digest(files, {"buildargs": {}}, known)
+
+
+def _timeit(func, repeat, setup=None) -> dict:
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"median": statistics.median(times), "min": min(times)}
+
+
+def run_scenario(name, shape, scale, repeat) -> dict:
+    cwd = os.getcwd()
+    root = make_workspace(name, shape, scale)
+    os.chdir(root)
+    try:
+        apps = sorted(os.listdir(root))
+        apps = [app for app in apps if app.startswith("bench_")]
+        all_args = [app_args(app) for app in apps]
+
+        def each(step, clean=False):
+            def run():
+                for args in all_args:
+                    args.clean = clean
+                    step(args)
+
+            return run
+
+        def clean_stage():
+            FM.remove("_build", ignorable=True)
+
+        def forget_apps():
+            # Versions are otherwise read from already imported modules
+            for module in [mod for mod in sys.modules if mod.startswith("bench_")]:
+                del sys.modules[module]
+            importlib.invalidate_caches()
+
+        results = {
+            "get_version": _timeit(
+                lambda: [
+                    versioning.get_version(app, "_build/.versions.json")
+                    for app in apps
+                ],
+                repeat,
+                forget_apps,
+            ),
+            "prepare_stage.cold": _timeit(
+                each(build.prepare_stage, clean=True), repeat, clean_stage
+            ),
+            # Everything already staged: only the manifest check should remain
+            "prepare_stage.warm": _timeit(each(build.prepare_stage), repeat),
+            "add_docker": _timeit(each(build.add_docker), repeat),
+            "env_file": _timeit(each(build.env_file), repeat),
+            "merge_yaml": _timeit(
+                lambda: FM.merge_yaml(
+                    "base.yaml", "over.yaml", outfile="out.yaml", clean=False
+                ),
+                repeat,
+            ),
+            "digest": _timeit(
+                lambda: [context_digest(args) for args in all_args], repeat
+            ),
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def compare(current, baseline, threshold, min_delta) -> list:
+    """(scenario, step, before, after) for each median slower than the baseline by
+    more than threshold (a fraction) and min_delta seconds
+    """
+    regressions = []
+    for scenario, steps in current["results"].items():
+        for step, timing in steps.items():
+            before = baseline["results"].get(scenario, {}).get(step)
+            if not before:
+                continue
+            after, prior = timing["median"], before["median"]
+            if after > prior * (1 + threshold) and after - prior > min_delta:
+                regressions.append((scenario, step, prior, after))
+    return regressions
+
+
+def table(current, baseline=None) -> str:
+    header = f"{'scenario': <12} {'step': <20} {'median': >9} {'min': >9} {'change': >8}"
+    lines = [header]
+    for scenario, steps in current["results"].items():
+        for step, timing in steps.items():
+            change = ""
+            before = (baseline or {}).get("results", {}).get(scenario, {}).get(step)
+            if before and before["median"]:
+                change = f"{timing['median'] / before['median'] - 1:+8.0%}"
+            lines.append(
+                f"{scenario: <12} {step: <20} {timing['median']:8.4f}s "
+                f"{timing['min']:8.4f}s {change: >8}"
+            )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "scenarios", nargs="*", help=f"Run only these, from {list(SCENARIOS)}"
+    )
+    parser.add_argument("-o", "--output", type=str, help="Save results as JSON")
+    parser.add_argument("--compare", type=str, help="Baseline JSON to compare with")
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="Runs per step (5)")
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="Multiply file counts/sizes (1.0)"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="Regression fraction (0.2)"
+    )
+    parser.add_argument(
+        "--min-delta", type=float, default=0.005, help="Ignore changes below (5ms)"
+    )
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario: '{name}' (choose from {list(SCENARIOS)})")
+
+    current = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "scale": args.scale,
+            "repeat": args.repeat,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": {},
+    }
+    for name in args.scenarios or SCENARIOS:
+        print(f"Running {name} ...", file=sys.stderr)
+        shape = SCENARIOS[name]
+        current["results"][name] = run_scenario(name, shape, args.scale, args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as fh:
+            baseline = json.load(fh)
+    print(table(current, baseline))
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(current, fh, indent=1, sort_keys=True)
+
+    if baseline:
+        regressions = compare(current, baseline, args.threshold, args.min_delta)
+        for scenario, step, before, after in regressions:
+            print(f"REGRESSION {scenario} {step}: {before:.4f}s -> {after:.4f}s")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Checks build.py's data snapshot step from a clean staging directory, both staged
+and streaming (-s), and that the image's entrypoint would use the snapshot without
+rehashing the data files.
+
+    python _bench/snapshot_check.py [--app housing]
+
+The app and the builder are copied into a temporary workspace. The image is
+imitated by unpacking the streamed build context. Exits non-zero on any failure.
+"""
+import argparse
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import build  # noqa: E402
+from _util import datacache, docker_context, environment  # noqa: E402
+from _util import file_management as FM  # noqa: E402
+
+
+def app_args(app, stream) -> argparse.Namespace:
+    """Build args as build.py's CLI would make them for -b (or -bs)"""
+    return argparse.Namespace(
+        app=app,
+        build_dir="_build",
+        stg_dir=f"_build/{app}",
+        entrypoint="entrypoint",
+        env=environment.ENV_SPEC(),
+        clean=True,
+        dev=False,
+        stream=stream,
+        execute=False,
+        build=True,
+        buildkit=False,
+        verbose=False,
+    )
+
+
+def unpack_context(args, dest) -> None:
+    """Extracts the streamed build context, as the image's /app would hold it"""
+    stream_args = argparse.Namespace(**{**vars(args), "stream": True})
+    tar = b"".join(docker_context.stream(build.context_files(stream_args)))
+    with tarfile.open(fileobj=io.BytesIO(tar)) as archive:
+        archive.extractall(dest, filter="tar")
+
+
+def check(app, stream) -> bool:
+    label = "streaming" if stream else "staged"
+    args = app_args(app, stream)
+    FM.remove("_build", ignorable=True)
+    build.prepare_stage(args)
+    build.snapshot_data(args)
+    modules = datacache.app_modules(app)
+    missing = [
+        module
+        for module in modules
+        if not os.path.exists(f"{build.snapshot_dir(args)}/{module}.load.json")
+    ]
+    if missing:
+        print(f"{label}: no snapshot for {', '.join(missing)}")
+        return False
+
+    # Containers should take the snapshot as it is, without hashing the sources
+    hashed = []
+    digest = datacache._digest
+    datacache._digest = lambda path: hashed.append(path) or digest(path)
+    cwd = os.getcwd()
+    image = tempfile.mkdtemp(dir=cwd)
+    try:
+        unpack_context(args, image)
+        os.chdir(image)
+        sys.path.insert(0, image)
+        for module in modules:
+            sys.modules.pop(module, None)
+            if not datacache.install(module):
+                print(f"{label}: {module} snapshot not installed in the image")
+                return False
+            sys.modules[module].load()
+    finally:
+        os.chdir(cwd)
+        sys.path.remove(image)
+        shutil.rmtree(image)
+        datacache._digest = digest
+    if hashed:
+        print(f"{label}: the image rehashed {', '.join(hashed)}")
+        return False
+    print(f"{label}: ok, {len(modules)} snapshot(s) used as built")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--app", default="housing", help="App to check (housing)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        for path in ("_util", "_docker", "ENV", args.app):
+            copy = shutil.copytree if os.path.isdir(path) else shutil.copy
+            copy(os.path.join(REPO, path), os.path.join(root, path))
+        os.chdir(root)
+        results = [check(args.app, stream=False), check(args.app, stream=True)]
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,218 @@
+"""An asyncio counterpart to DockerManager, speaking the Docker Engine API directly
+over the daemon's unix socket. One manager keeps a pool of keep-alive connections
+for its lifetime, so many builds, pushes and inspects can run concurrently on a
+single event loop, without a thread per streaming response.
+
+    async with AsyncDockerManager() as adm:
+        async for event in adm.build({"tag": tag, "path": stg_dir}):
+            ...
+"""
+import asyncio
+import base64
+import json
+import urllib.parse
+
+from _util import docker_context, logger
+from _util.build_events import BuildEventParser, ContextSent
+from _util.docker_manager import split_tag
+
+logging = logger.fancy_logger("docker")
+
+
+class DockerError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+class AsyncDockerManager:
+    def __init__(self, docksock="/var/run/docker.sock", pool_size=8, api="1.41"):
+        self.docksock = docksock
+        self.api = api
+        self.idle = []
+        self.slots = asyncio.Semaphore(pool_size)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        while self.idle:
+            _, writer = self.idle.pop()
+            writer.close()
+
+    async def _acquire(self):
+        await self.slots.acquire()
+        if self.idle:
+            return self.idle.pop()
+        try:
+            return await asyncio.open_unix_connection(self.docksock)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def _release(self, conn, reusable):
+        if reusable:
+            self.idle.append(conn)
+        else:
+            conn[1].close()
+        self.slots.release()
+
+    def _url(self, path, params=None):
+        query = {k: v for k, v in (params or {}).items() if v is not None}
+        url = f"/v{self.api}{path}"
+        return f"{url}?{urllib.parse.urlencode(query)}" if query else url
+
+    async def _send(self, writer, method, url, headers, body):
+        head = [f"{method} {url} HTTP/1.1", "Host: docker"]
+        head += [f"{key}: {value}" for key, value in headers.items()]
+        if body is None or isinstance(body, bytes):
+            head.append(f"Content-Length: {len(body or b'')}")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + (body or b""))
+            await writer.drain()
+            return
+
+        # Iterables (e.g. a context tar stream) go out chunked, read off the loop
+        head.append("Transfer-Encoding: chunked")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode())
+        loop = asyncio.get_running_loop()
+        chunks = iter(body)
+        while True:
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _body(self, reader, headers):
+        """Yields raw body chunks, decoding chunked transfer encoding"""
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if not size:
+                    await reader.readline()
+                    return
+                yield await reader.readexactly(size)
+                await reader.readline()
+        elif "content-length" in headers:
+            remaining = int(headers["content-length"])
+            if remaining:
+                yield await reader.readexactly(remaining)
+        else:
+            while True:
+                chunk = await reader.read(1 << 16)
+                if not chunk:
+                    return
+                yield chunk
+
+    async def _request(self, method, path, params=None, headers=None, body=None):
+        """Yields the decoded JSON objects of a (possibly streaming) response"""
+        conn = await self._acquire()
+        reader, writer = conn
+        reusable = False
+        try:
+            url = self._url(path, params)
+            await self._send(writer, method, url, headers or {}, body)
+            status = int((await reader.readline()).split()[1])
+            resp_headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                key, _, value = line.partition(":")
+                resp_headers[key.strip().lower()] = value.strip()
+
+            decoder, buffer = json.JSONDecoder(), ""
+            async for chunk in self._body(reader, resp_headers):
+                buffer += chunk.decode("utf-8", "replace")
+                while True:
+                    buffer = buffer.lstrip()
+                    try:
+                        obj, end = decoder.raw_decode(buffer)
+                    except json.JSONDecodeError:
+                        break
+                    buffer = buffer[end:]
+                    if status >= 400:
+                        raise DockerError(status, obj.get("message", obj))
+                    yield obj
+            if status >= 400:
+                raise DockerError(status, buffer.strip())
+            reusable = resp_headers.get("connection", "").lower() != "close"
+        finally:
+            self._release(conn, reusable)
+
+    async def build(self, context, labels=None, report=None):
+        """Streams the build's typed events (see build_events). Context holds a tag
+        and either a path or a fileobj: an iterable of tar chunks. A BuildReport
+        passed as report is filled in for this build alone, so builds can run
+        concurrently on one manager.
+        """
+        if context.get("fileobj") is not None:
+            chunks = context["fileobj"]
+        else:
+            ignore = docker_context.read_ignore(f"{context['path']}/.dockerignore")
+            files = docker_context.collect([(context["path"], "")], ignore)
+            chunks = docker_context.stream(files)
+
+        sent = {"bytes": 0}
+
+        def counted(chunks):
+            for chunk in chunks:
+                sent["bytes"] += len(chunk)
+                yield chunk
+
+        params = {"t": context["tag"], "rm": 1}
+        if labels:
+            params["labels"] = json.dumps(labels)
+        headers = {"Content-Type": "application/x-tar"}
+        parser = BuildEventParser()
+        if report is not None:
+            parser.report = report
+        body = counted(chunks)
+        responded = False
+        async for chunk in self._request("POST", "/build", params, headers, body):
+            # The whole context is uploaded before the daemon responds
+            if not responded:
+                responded = True
+                parser.report.context_bytes = sent["bytes"]
+                yield ContextSent(sent["bytes"])
+            for event in parser.feed(chunk):
+                yield event
+        for event in parser.close():
+            yield event
+
+    async def push(self, tag):
+        """Streams the push's progress events"""
+        repository, version = split_tag(tag)
+        headers = {"X-Registry-Auth": _auth_header(repository)}
+        path = f"/images/{urllib.parse.quote(repository, safe='/:')}/push"
+        async for event in self._request("POST", path, {"tag": version}, headers):
+            yield event
+
+    async def inspect(self, tag):
+        """The image's inspect data, or None if there is no such image locally"""
+        path = f"/images/{urllib.parse.quote(tag, safe='/:')}/json"
+        try:
+            found = [info async for info in self._request("GET", path)]
+        except DockerError as exc:
+            if exc.status == 404:
+                return None
+            raise
+        return found[0] if found else None
+
+
+def _auth_header(repository) -> str:
+    """Registry credentials from the docker config, encoded as the API expects"""
+    from docker import auth
+
+    try:
+        registry, _ = auth.resolve_repository_name(repository)
+        authconfig = auth.resolve_authconfig(auth.load_config(), registry) or {}
+    except Exception:
+        authconfig = {}
+    return base64.urlsafe_b64encode(json.dumps(authconfig).encode()).decode()
@@ -0,0 +1,166 @@
+"""Typed events parsed from a Docker build's output stream, and a report of where
+the build's time went: per-step durations and which steps missed the cache.
+"""
+import re
+import time
+from dataclasses import dataclass, field
+from typing import List
+
+
+@dataclass
+class ContextSent:
+    bytes: int
+
+
+@dataclass
+class StepStarted:
+    index: int
+    total: int
+    instruction: str
+
+
+@dataclass
+class StepFinished:
+    index: int
+    total: int
+    instruction: str
+    duration: float
+    cached: bool
+
+
+@dataclass
+class BuildOutput:
+    text: str
+
+
+@dataclass
+class BuildError:
+    message: str
+
+
+@dataclass
+class BuildReport:
+    steps: List[StepFinished] = field(default_factory=list)
+    context_bytes: int = 0
+    duration: float = 0.0
+    error: str = ""
+
+    def misses(self) -> List[StepFinished]:
+        # FROM only pulls/references the base image, it has no cache to miss
+        return [
+            step
+            for step in self.steps
+            if not step.cached and not step.instruction.upper().startswith("FROM")
+        ]
+
+    def table(self) -> str:
+        misses = self.misses()
+        lines = [
+            f"Build {'failed' if self.error else 'done'} in {self.duration:.1f}s, "
+            f"context {self.context_bytes / 2 ** 20:.1f} MB, "
+            f"{len(misses)}/{len(self.steps)} steps missed cache"
+        ]
+        for step in sorted(self.steps, key=lambda step: step.index):
+            cache = "MISS" if step in misses else "hit " if step.cached else "-   "
+            lines.append(
+                f"{step.index: >3}/{step.total:<3} {cache} {step.duration:7.2f}s  "
+                f"{step.instruction}"
+            )
+        return "\n".join(lines)
+
+
+STEP_RE = re.compile(r"^Step (\d+)/(\d+) : (.*)$")
+# BuildKit's --progress=plain output, e.g. "#7 [3/5] COPY . ./" then "#7 DONE 0.4s"
+VERTEX_RE = re.compile(r"^#(\d+) (.*)$")
+VERTEX_STEP_RE = re.compile(r"^\[(?:[\w.-]+ )?(\d+)/(\d+)\] (.*)$")
+VERTEX_DONE_RE = re.compile(r"^DONE (\d+(?:\.\d+)?)s$")
+
+
+class BuildEventParser:
+    """Turns raw build chunks (decoded JSON from the daemon) into typed events"""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.current = None
+        self.started = 0.0
+        self.cached = False
+        self.report = BuildReport()
+        self.begin = clock()
+        # BuildKit runs steps (vertices) concurrently, so track each separately
+        self.vertices = {}
+
+    def _finish(self):
+        if not self.current:
+            return []
+        step = StepFinished(
+            index=self.current.index,
+            total=self.current.total,
+            instruction=self.current.instruction,
+            duration=self.clock() - self.started,
+            cached=self.cached,
+        )
+        self.report.steps.append(step)
+        self.current = None
+        return [step]
+
+    def feed(self, chunk) -> list:
+        events = []
+        if "error" in chunk:
+            events += self._finish()
+            self.report.error = chunk["error"]
+            events.append(BuildError(chunk["error"]))
+        for line in chunk.get("stream", "").splitlines():
+            match = STEP_RE.match(line.strip())
+            if match:
+                events += self._finish()
+                index, total, instruction = match.groups()
+                self.current = StepStarted(int(index), int(total), instruction)
+                self.started = self.clock()
+                self.cached = False
+                events.append(self.current)
+            elif "Using cache" in line:
+                self.cached = True
+            elif line.startswith("Successfully built"):
+                events += self._finish()
+                events.append(BuildOutput(line))
+            elif line.strip():
+                events.append(BuildOutput(line))
+        return events
+
+    def feed_plain(self, line) -> list:
+        """Parses a line of BuildKit's plain progress output"""
+        match = VERTEX_RE.match(line.strip())
+        if not match:
+            return [BuildOutput(line.rstrip())] if line.strip() else []
+        vertex, text = match.groups()
+        step = VERTEX_STEP_RE.match(text)
+        if step:
+            index, total, instruction = step.groups()
+            started = StepStarted(int(index), int(total), instruction)
+            self.vertices[vertex] = (started, self.clock())
+            return [started]
+        if vertex not in self.vertices:
+            return []
+        started, start_time = self.vertices[vertex]
+        done = VERTEX_DONE_RE.match(text)
+        if text == "CACHED" or done:
+            del self.vertices[vertex]
+            duration = float(done.group(1)) if done else self.clock() - start_time
+            finished = StepFinished(
+                index=started.index,
+                total=started.total,
+                instruction=started.instruction,
+                duration=duration,
+                cached=not done,
+            )
+            self.report.steps.append(finished)
+            return [finished]
+        if text.startswith("ERROR"):
+            self.report.error = text
+            return [BuildError(f"{started.instruction}: {text}")]
+        return []
+
+    def close(self) -> list:
+        events = self._finish()
+        self.report.duration = self.clock() - self.begin
+        return events
@@ -0,0 +1,292 @@
+"""Caches what a data module's load() returns, so each process (e.g. every gunicorn
+worker) reads a binary snapshot instead of re-parsing and cleaning its sources.
+
+    @datacache.cached("housing/zillow_housing_2020.csv")
+    def load():
+        ...
+
+The dataframe is stored as an uncompressed Arrow file, the rest of the returned
+dict ("keys", "types", ...) is pickled into its metadata. Without pyarrow (or for
+data Arrow can't hold), the whole result is pickled. What a snapshot saves is the
+parsing and cleaning: it's read through a memory map, but then converted into an
+ordinary dataframe, so each process still holds its own copy of the data.
+
+A snapshot is used only while the source files and the loader's module are
+unchanged; sources are content hashed, rehashing only when their size or
+modification time (to the second) differ from the snapshot's record.
+
+When building an image, build.py runs python -m _util.datacache <app> from the
+repo root, snapshotting each of the app's data modules into SNAPSHOT_DIR of its
+staging directory. The image's entrypoint installs them, so containers start
+from them.
+"""
+import argparse
+import functools
+import hashlib
+import importlib
+import json
+import os
+import pickle
+import sys
+
+from _util import logger
+
+logging = logger.fancy_logger(__name__)
+
+# Relative to the working directory, i.e. the app's staging dir or /app in the image
+CACHE_DIR = os.environ.get("DATA_CACHE_DIR", ".datacache")
+# Where build.py saves snapshots for the image, in their own layer after the data
+SNAPSHOT_DIR = "_snapshots"
+# Arrow schema metadata key holding the pickled rest of the loaded dict
+REST_KEY = b"datacache.rest"
+
+
+def _digest(path, chunk_size=1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _stat(path) -> list:
+    # Whole seconds, as the image's build context tar keeps no finer mtimes
+    stat = os.stat(path)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def code_version(load) -> str:
+    """Hash of the loader's module source (or of its bytecode, without a source)"""
+    module_file = getattr(sys.modules.get(load.__module__), "__file__", None)
+    try:
+        with open(module_file, "rb") as fh:
+            return hashlib.sha256(fh.read()).hexdigest()
+    except (OSError, TypeError):
+        return hashlib.sha256(load.__code__.co_code).hexdigest()
+
+
+def source_hashes(sources, known=None) -> dict:
+    """{path: [size, mtime, hash]}, reusing the hash from known when size and
+    mtime still match (as they do in an image built from the recorded files)
+    """
+    known = known or {}
+    hashes = {}
+    for path in sources:
+        stat = _stat(path)
+        entry = known.get(path)
+        if entry and entry[:2] == stat:
+            hashes[path] = entry
+        else:
+            hashes[path] = stat + [_digest(path)]
+    return hashes
+
+
+def _paths(name, cache_dir) -> dict:
+    base = os.path.join(cache_dir or CACHE_DIR, name)
+    return {"meta": f"{base}.json", "arrow": f"{base}.arrow", "pickle": f"{base}.pkl"}
+
+
+def _read_meta(path) -> dict:
+    try:
+        with open(path, "r") as fh:
+            return json.load(fh)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_atomic(path, write) -> None:
+    """Calls write(tmp_path), then moves tmp_path to path, so concurrent readers
+    never see a partial file
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _arrow_table(data):
+    """The data's dataframe as an Arrow table carrying the rest of the dict, or None
+    if pyarrow is missing or can't hold it
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        return None
+    if not isinstance(data, dict) or "df" not in data:
+        return None
+    rest = {key: value for key, value in data.items() if key != "df"}
+    try:
+        table = pyarrow.Table.from_pandas(data["df"])
+    except (pyarrow.ArrowException, TypeError, ValueError) as exc:
+        logging.debug(f"Can't store the dataframe with Arrow ({exc}), pickling")
+        return None
+    metadata = {**(table.schema.metadata or {}), REST_KEY: pickle.dumps(rest)}
+    return table.replace_schema_metadata(metadata)
+
+
+def _write_arrow(table, path) -> None:
+    import pyarrow
+
+    with pyarrow.OSFile(path, "wb") as sink:
+        with pyarrow.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def _read_arrow(path) -> dict:
+    import pyarrow
+
+    with pyarrow.memory_map(path, "r") as source:
+        table = pyarrow.ipc.open_file(source).read_all()
+    data = pickle.loads(table.schema.metadata[REST_KEY])
+    # A copy: zero-copy columns would be read-only, breaking in-place edits of df
+    return {"df": table.to_pandas(), **data}
+
+
+def _write_meta(meta, path) -> None:
+    def write(tmp):
+        with open(tmp, "w") as fh:
+            json.dump(meta, fh)
+
+    _write_atomic(path, write)
+
+
+def _read_pickle(path):
+    with open(path, "rb") as fh:
+        return pickle.load(fh)
+
+
+def save(data, name, key, sources, cache_dir=None) -> str:
+    """Writes the snapshot, returning its format ("arrow" or "pickle")"""
+    paths = _paths(name, cache_dir)
+    os.makedirs(os.path.dirname(paths["meta"]), exist_ok=True)
+    table = _arrow_table(data)
+    if table is not None:
+        fmt = "arrow"
+        _write_atomic(paths["arrow"], lambda tmp: _write_arrow(table, tmp))
+    else:
+        fmt = "pickle"
+
+        def write(tmp):
+            with open(tmp, "wb") as fh:
+                pickle.dump(data, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+        _write_atomic(paths["pickle"], write)
+    # The metadata goes last, so it never points to a missing or older snapshot
+    meta = {"key": key, "format": fmt, "sources": sources}
+    _write_meta(meta, paths["meta"])
+    stale = paths["pickle" if fmt == "arrow" else "arrow"]
+    if os.path.exists(stale):
+        os.remove(stale)
+    return fmt
+
+
+def fetch(load, sources=(), name=None, cache_dir=None):
+    """load()'s result, from the snapshot while it's current, otherwise from load()
+    (then saved as the new snapshot)
+    """
+    name = name or f"{load.__module__}.{load.__qualname__}"
+    paths = _paths(name, cache_dir)
+    meta = _read_meta(paths["meta"])
+    try:
+        hashes = source_hashes(sources, meta.get("sources"))
+    except FileNotFoundError as exc:
+        logging.warning(f"{name}: source {exc.filename} missing, not caching")
+        return load()
+    versions = [code_version(load)] + [hashes[path][2] for path in sources]
+    key = hashlib.sha256(json.dumps(versions).encode()).hexdigest()
+
+    if meta.get("key") == key:
+        try:
+            reader = _read_arrow if meta["format"] == "arrow" else _read_pickle
+            data = reader(paths[meta["format"]])
+            logging.debug(f"{name}: loaded {meta['format']} snapshot")
+            if hashes != meta["sources"]:
+                # Same content, new mtimes: record them to skip rehashing next time
+                try:
+                    _write_meta({**meta, "sources": hashes}, paths["meta"])
+                except OSError:
+                    pass
+            return data
+        except Exception as exc:
+            # A snapshot is only ever an optimization, so never fatal
+            logging.warning(f"{name}: unreadable snapshot ({exc}), reloading")
+
+    data = load()
+    try:
+        fmt = save(data, name, key, hashes, cache_dir)
+        logging.info(f"{name}: saved {fmt} snapshot to {paths[fmt]}")
+    except (OSError, pickle.PicklingError, TypeError, AttributeError) as exc:
+        # E.g. a read-only filesystem in the container, or unpicklable "types"
+        logging.warning(f"{name}: couldn't save a snapshot ({exc})")
+    return data
+
+
+def cached(*sources, name=None, cache_dir=None):
+    """Decorates a data module's load(), caching its result keyed on the content of
+    the source files and on the loader's module code
+    """
+
+    def decorator(load):
+        @functools.wraps(load)
+        def wrapper():
+            return fetch(load, sources, name, cache_dir)
+
+        wrapper.uncached = load
+        wrapper.sources = sources
+        return wrapper
+
+    return decorator
+
+
+def snapshot(module_name, extra=(), cache_dir=SNAPSHOT_DIR):
+    """Runs the data module's load() (unless its snapshot is current) and saves the
+    result, keyed on the module's own sources (if decorated) and on extra ones
+    """
+    module = importlib.import_module(module_name)
+    load = getattr(module.load, "uncached", module.load)
+    sources = list(getattr(module.load, "sources", ()))
+    sources += [path for path in extra if path not in sources]
+    return fetch(load, sources, f"{module_name}.load", cache_dir)
+
+
+def install(module_name, cache_dir=SNAPSHOT_DIR) -> bool:
+    """Points the data module's load() at its snapshot, if there is one (keeping
+    the sources it was saved with), so load() only runs if the snapshot is stale.
+    Returns False, leaving load() as it is, without a snapshot.
+    """
+    name = f"{module_name}.load"
+    meta = _read_meta(_paths(name, cache_dir)["meta"])
+    if not meta:
+        return False
+    module = importlib.import_module(module_name)
+    load = getattr(module.load, "uncached", module.load)
+    module.load = cached(*meta["sources"], name=name, cache_dir=cache_dir)(load)
+    return True
+
+
+def app_modules(app) -> list:
+    """The app's own data modules, listed in its descriptor's "data" """
+    descriptor = importlib.import_module(f"{app}.descriptor").descriptor
+    modules = [entry.get("module", "") for entry in descriptor.get("data", {}).values()]
+    return [module for module in modules if module.startswith(f"{app}.")]
+
+
+if __name__ == "__main__":
+    # Run by build.py from the repo root, with --cache_dir in the app's staging dir
+    parser = argparse.ArgumentParser(description="Snapshots an app's data modules")
+    parser.add_argument("app", help="App whose descriptor lists the data modules")
+    parser.add_argument("--sources", nargs="*", default=[], help="Data files")
+    parser.add_argument("--cache_dir", default=SNAPSHOT_DIR, help=f"({SNAPSHOT_DIR})")
+    args = parser.parse_args()
+
+    failed = []
+    for module_name in app_modules(args.app):
+        try:
+            snapshot(module_name, args.sources, args.cache_dir)
+        except Exception as exc:
+            logging.warning(f"{module_name}: no snapshot, load() failed: {exc!r}")
+            failed.append(module_name)
+    sys.exit(1 if failed else 0)
@@ -1,4 +1,7 @@
+import bisect
+import functools
 import re
+from typing import NamedTuple
 
 from _util import logutil  # noqa
 from _util.logger import fancy_logger
@@ -26,23 +29,33 @@ def process_inputs(input_dictionary):
     return {_cid2c(key): val for key, val in input_dictionary.items()}
 
 
+@functools.lru_cache(maxsize=256)
+def _pattern(regex):
+    return re.compile(regex)
+
+
 def extract(regex, input_dictionary, unique=False, pop=True):
     """Splits off a subset dictionary with keys matching the provided 'path' prefix"""
     method = "pop" if pop else "get"
-    match_keys = [key for key in input_dictionary if re.search(regex, key)]
+    search = _pattern(regex).search
+    match_keys = [key for key in input_dictionary if search(key)]
     output = {key: getattr(input_dictionary, method)(key) for key in match_keys}
     return output
 
 
 def extract_unique(regex, input_dictionary, pop=True, default=None):
     method = "pop" if pop else "get"
-    match_keys = [key for key in input_dictionary if re.search(regex, key)]
+    search = _pattern(regex).search
+    match_keys = [key for key in input_dictionary if search(key)]
     output = {key: getattr(input_dictionary, method)(key) for key in match_keys}
+    return _unique(regex, output, input_dictionary, default)
+
 
-    if len(match_keys) > 1:
-        logging.warning(f"Regex {regex} not unique: {len(match_keys)} matches")
+def _unique(regex, output, input_dictionary, default):
+    if len(output) > 1:
+        logging.warning(f"Regex {regex} not unique: {len(output)} matches")
         logging.warning(input_dictionary)
-    elif len(match_keys) == 0:
+    elif len(output) == 0:
         return default
     else:
         return pluck(output)[0]
@@ -55,6 +68,95 @@ def extract_path(path, input_dictionary):
     return output
 
 
+class Cid(NamedTuple):
+    """The parts of a component id, e.g. main_page/axis_controls|x_column.value"""
+
+    page: str
+    bank: str
+    component: str
+    prop: str
+
+
+def parse_cid(cid) -> Cid:
+    page, rest = cid.split("/", 1) if "/" in cid else ("", cid)
+    bank, _, rest = rest.rpartition("|")
+    component, _, prop = rest.partition(".")
+    return Cid(page, bank, component, prop)
+
+
+class CidIndex:
+    """The cids of a callback's inputs, parsed once so the per-call helpers above
+    become lookups. Build one per callback signature (see cid_index); the methods
+    take the inputs dict of a call, whose keys are the indexed cids.
+    """
+
+    def __init__(self, cids):
+        self.cids = tuple(cids)
+        self.parsed = {cid: parse_cid(cid) for cid in self.cids}
+        self.components = {cid: _cid2c(cid) for cid in self.cids}
+        # Sorted for pluck, and for prefix lookups by bisection
+        self.sorted = sorted(self.cids)
+        self.fields = {field: {} for field in Cid._fields}
+        for cid, parts in self.parsed.items():
+            for field, value in zip(Cid._fields, parts):
+                self.fields[field].setdefault(value, []).append(cid)
+        # Results of each pattern or prefix, as they're asked for
+        self.matches = {}
+        self.prefixes = {}
+
+    def select(self, **parts) -> list:
+        """Cids with the given parts, e.g. select(page="main_page", prop="value")"""
+        found = None
+        for field, value in parts.items():
+            cids = self.fields[field].get(value, [])
+            if found is not None:
+                cids = set(cids)
+                cids = [cid for cid in found if cid in cids]
+            found = cids
+        return list(self.cids if found is None else found)
+
+    def match(self, regex) -> tuple:
+        if regex not in self.matches:
+            search = _pattern(regex).search
+            self.matches[regex] = tuple(cid for cid in self.cids if search(cid))
+        return self.matches[regex]
+
+    def prefixed(self, path) -> tuple:
+        if path not in self.prefixes:
+            start = bisect.bisect_left(self.sorted, path)
+            end = start
+            while end < len(self.sorted) and self.sorted[end].startswith(path):
+                end += 1
+            self.prefixes[path] = tuple(self.sorted[start:end])
+        return self.prefixes[path]
+
+    def pluck(self, input_dictionary) -> list:
+        """As pluck: values sorted by cid (of those left after any extracts)"""
+        return [input_dictionary[cid] for cid in self.sorted if cid in input_dictionary]
+
+    def process_inputs(self, input_dictionary) -> dict:
+        return {self.components[key]: val for key, val in input_dictionary.items()}
+
+    def extract(self, regex, input_dictionary, pop=True) -> dict:
+        method = input_dictionary.pop if pop else input_dictionary.get
+        keys = [key for key in self.match(regex) if key in input_dictionary]
+        return {key: method(key) for key in keys}
+
+    def extract_unique(self, regex, input_dictionary, pop=True, default=None):
+        output = self.extract(regex, input_dictionary, pop=pop)
+        return _unique(regex, output, input_dictionary, default)
+
+    def extract_path(self, path, input_dictionary) -> dict:
+        keys = [key for key in self.prefixed(path) if key in input_dictionary]
+        return {key.replace(path, ""): input_dictionary.pop(key) for key in keys}
+
+
+@functools.lru_cache(maxsize=128)
+def cid_index(cids: tuple) -> CidIndex:
+    """The (cached) CidIndex of a callback signature, e.g. cid_index(tuple(inputs))"""
+    return CidIndex(cids)
+
+
 def merge(d_base, d_in, loc=None):
     """Adds leaves of nested dict d_in to d_base, keeping d_base where overlapping"""
     loc = loc or []
@@ -72,42 +174,50 @@ def merge(d_base, d_in, loc=None):
     return d_base
 
 
-# @logutil.loginfo()
-def flatten(dict_in, delim="__", loc=[]):
-    """Un-nests the dict by combining keys, e.g. {'a': {'b': 1}} -> {'a_b': 1}"""
+def iflatten(dict_in, delim="__", loc=None):
+    """Yields the (key, value) pairs of flatten, depth first, without building the
+    flattened dict. Walks with an explicit stack, so depth isn't recursion-limited.
+    """
     loc = loc or []
-    output = {}
+    prefix = delim.join(loc) + delim if loc else ""
     if not dict_in and loc:
-        output[delim.join(loc)] = {}
-    for key in dict_in:
-        if isinstance(dict_in[key], dict):
-            nest_out = flatten(dict_in[key], delim=delim, loc=loc + [str(key)])
-            output.update(nest_out)
+        yield delim.join(loc), {}
+        return
+    # Each level holds its remaining items and the key prefix built once for it
+    stack = [(iter(dict_in.items()), prefix)]
+    while stack:
+        items, prefix = stack[-1]
+        for key, value in items:
+            if not isinstance(value, dict):
+                yield prefix + str(key), value
+            elif value:
+                stack.append((iter(value.items()), prefix + str(key) + delim))
+                break
+            else:
+                # Empty dicts are kept as leaves, so nest can restore them
+                yield prefix + str(key), {}
         else:
-            base_key = delim.join(loc + [str(key)])
-            output[base_key] = dict_in[key]
-    return output
+            stack.pop()
+
+
+# @logutil.loginfo()
+def flatten(dict_in, delim="__", loc=None):
+    """Un-nests the dict by combining keys, e.g. {'a': {'b': 1}} -> {'a_b': 1}"""
+    return dict(iflatten(dict_in, delim=delim, loc=loc))
 
 
 def nest(dict_in, delim="__"):
-    """Nests the input dict by splitting keys (opposite of flatten above)"""
-    # We will loop through all keys first, and keep track of any first-level keys
-    # that will require a recursive nest call. 'renest' stores these keys
-    output, renest = {}, []
-    for key in dict_in:
-        if delim not in key:
-            output[key] = dict_in[key]
-            continue
-        loc = key.split(delim, 1)
-        if loc[0] not in output:
-            output[loc[0]] = {}
-            # Uniquely add the key to the subdictionary we want to renest
-            renest.append(loc[0])
-        output[loc[0]][loc[1]] = dict_in[key]
-
-    # Renest all higher-level dictionaries
-    for renest_key in renest:
-        output[renest_key] = nest(output[renest_key])
+    """Nests the input dict by splitting keys (opposite of flatten above). Also takes
+    an iterable of (key, value) pairs, e.g. from iflatten.
+    """
+    items = dict_in.items() if isinstance(dict_in, dict) else dict_in
+    output = {}
+    for key, value in items:
+        *parents, leaf = key.split(delim)
+        node = output
+        for part in parents:
+            node = node.setdefault(part, {})
+        node[leaf] = value
     return output
 
 
@@ -0,0 +1,177 @@
+"""Assembles a Docker build context as a tar stream read straight from the source
+files, so large contexts are never written to disk a second time.
+"""
+import functools
+import glob
+import hashlib
+import json
+import os
+import re
+import stat
+import tarfile
+
+from _util import logger, tracing
+from _util import file_management as FM
+
+logging = logger.fancy_logger(__name__)
+
+CHUNK_SIZE = 1 << 20
+
+# Image label recording the digest of the context an image was built from
+DIGEST_LABEL = "bento.context.digest"
+
+
+def read_ignore(path) -> list:
+    """Reads .dockerignore-style patterns, skipping blanks and comments"""
+    try:
+        with open(path, "r") as fh:
+            lines = [line.strip() for line in fh]
+    except FileNotFoundError:
+        return []
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+@functools.lru_cache(maxsize=None)
+def _compile(pattern):
+    """Translates a .dockerignore pattern (Go filepath.Match plus '**') to a regex"""
+    pattern = os.path.normpath(pattern.lstrip("/")).replace(os.sep, "/")
+    regex = ""
+    idx = 0
+    while idx < len(pattern):
+        char = pattern[idx]
+        if pattern.startswith("**/", idx):
+            # Any number of directories, including none
+            regex += "(.*/)?"
+            idx += 3
+            continue
+        elif pattern.startswith("**", idx):
+            regex += ".*"
+            idx += 2
+            continue
+        elif char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[":
+            end = pattern.find("]", idx)
+            if end < 0:
+                regex += re.escape(char)
+            else:
+                regex += pattern[idx : end + 1].replace("[!", "[^")
+                idx = end
+        else:
+            regex += re.escape(char)
+        idx += 1
+    return re.compile(f"{regex}$")
+
+
+def excluded(arcname, patterns) -> bool:
+    """Applies patterns in order, the last match deciding; '!' re-includes a path.
+    A path is also matched by patterns matching any of its parent directories.
+    """
+    parts = arcname.split("/")
+    candidates = ["/".join(parts[: idx + 1]) for idx in range(len(parts))]
+    result = False
+    for pattern in patterns:
+        negate = pattern.startswith("!")
+        regex = _compile(pattern[1:] if negate else pattern)
+        if any(regex.match(path) for path in candidates):
+            result = not negate
+    return result
+
+
+def _expand(src, arcroot):
+    """Yields (path, arcname) for a file, every file below a directory, or a glob"""
+
+    def join(rel):
+        return f"{arcroot}/{rel}" if arcroot else rel
+
+    if "*" in src:
+        for path in sorted(glob.glob(src)):
+            if os.path.isfile(path):
+                yield path, join(os.path.basename(path))
+    elif os.path.isdir(src):
+        for root, dirs, fnames in os.walk(src):
+            dirs.sort()
+            for fname in sorted(fnames):
+                path = os.path.join(root, fname)
+                yield path, join(os.path.relpath(path, src).replace(os.sep, "/"))
+    elif os.path.lexists(src):
+        yield src, arcroot or os.path.basename(src)
+    else:
+        logging.debug(f"Context source {src} not found, skipping")
+
+
+@tracing.traced()
+def collect(sources, patterns=None) -> list:
+    """Lists (path, arcname) for the files of the context, ordered by arcname.
+    Sources are (src, arcroot) pairs, with src a file, directory or glob, plus an
+    optional predicate on paths. Later sources win when arcnames collide.
+    """
+    patterns = patterns or []
+    files = {}
+    for src, arcroot, *include in sources:
+        for path, arcname in _expand(src, arcroot):
+            if include and not include[0](path):
+                continue
+            if not excluded(arcname, patterns):
+                files[arcname] = path
+    return [(path, arcname) for arcname, path in sorted(files.items())]
+
+
+def _tarinfo(path, arcname):
+    st = os.lstat(path)
+    info = tarfile.TarInfo(arcname)
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.mtime = int(st.st_mtime)
+    if stat.S_ISLNK(st.st_mode):
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.readlink(path)
+    else:
+        info.size = st.st_size
+    return info
+
+
+def stream(files, chunk_size=CHUNK_SIZE):
+    """Generates an uncompressed tar archive of files chunk by chunk, reading each
+    file only as it is sent. Suitable for APIClient.build(custom_context=True).
+    """
+    for path, arcname in files:
+        info = _tarinfo(path, arcname)
+        yield info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        if info.type != tarfile.REGTYPE:
+            continue
+        remaining = info.size
+        with open(path, "rb") as fh:
+            while remaining > 0:
+                chunk = fh.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise OSError(f"{path} shrank while building the context")
+                remaining -= len(chunk)
+                yield chunk
+        padding = -info.size % tarfile.BLOCKSIZE
+        if padding:
+            yield tarfile.NUL * padding
+
+    # End-of-archive marker
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+@tracing.traced()
+def digest(files, extra=None, known=None) -> str:
+    """Deterministic hash over the context's arcnames, modes and file contents,
+    plus any extra build inputs (e.g. build args). Timestamps are ignored.
+    Known maps paths to content hashes already computed, e.g. by staging.
+    """
+    known = known or {}
+    context_hash = hashlib.sha256()
+    for path, arcname in files:
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+            content = f"->{os.readlink(path)}"
+        else:
+            content = known.get(path) or FM.file_digest(path)
+        context_hash.update(f"{arcname}\0{stat.S_IMODE(st.st_mode):o}\0".encode())
+        context_hash.update(f"{content}\n".encode())
+    context_hash.update(json.dumps(extra or {}, sort_keys=True).encode())
+    return context_hash.hexdigest()
@@ -1,96 +1,389 @@
 """A high-level wrapper around docker-py
 """
-import docker
-import re
-import tqdm
+import concurrent.futures
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
 
-from _util import logger, logutil
+from _util import docker_context, logger, logutil, tracing
+from _util.build_events import BuildError, BuildEventParser, BuildReport
+from _util.build_events import ContextSent, StepFinished
+from _util.docker_context import DIGEST_LABEL
 
 logging = logger.fancy_logger("docker")
 
+# Serializes updates to the build cache record across concurrent builds
+_record_lock = threading.Lock()
+
+
+def load_record(path) -> dict:
+    try:
+        with open(path, "r") as fh:
+            return json.load(fh)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
 
 class DockerManager:
     def __init__(self):
         self.template_file = "docker_v1"
         self.docksock = "unix://var/run/docker.sock"
 
+    def client(self):
+        # docker-py is slow to import, so only the steps talking to the daemon load it
+        import docker
+
+        return docker.APIClient(base_url=self.docksock)
+
+    def is_current(self, tag, digest, record_file=None) -> bool:
+        """Whether the local image for tag was built from a context with this digest"""
+        recorded = load_record(record_file).get(tag, {}) if record_file else {}
+        if record_file and recorded.get("digest") != digest:
+            return False
+        from docker.errors import ImageNotFound
+
+        client = self.client()
+        try:
+            labels = client.inspect_image(tag)["Config"].get("Labels") or {}
+        except ImageNotFound:
+            return False
+        return labels.get(DIGEST_LABEL) == digest
+
+    def record_build(self, tag, digest, record_file) -> None:
+        """Notes the digest and image id of a finished build in the local record"""
+        client = self.client()
+        image_id = client.inspect_image(tag)["Id"]
+        with _record_lock:
+            record = load_record(record_file)
+            record[tag] = {"digest": digest, "image": image_id, "time": time.time()}
+            with open(record_file, "w") as fh:
+                json.dump(record, fh, indent=1, sort_keys=True)
+
+    def build_events(self, context, labels=None):
+        """Yields typed events (see build_events) for a build of the context, which
+        holds a tag and either a staged path or a fileobj of tar chunks.
+        """
+        if context.get("fileobj") is not None:
+            chunks = context["fileobj"]
+        else:
+            ignore = docker_context.read_ignore(f"{context['path']}/.dockerignore")
+            files = docker_context.collect([(context["path"], "")], ignore)
+            chunks = docker_context.stream(files)
+
+        sent = {"bytes": 0}
+
+        def counted(chunks):
+            for chunk in chunks:
+                sent["bytes"] += len(chunk)
+                yield chunk
+
+        client = self.client()
+        output = client.build(
+            decode=True,
+            tag=context["tag"],
+            labels=labels,
+            fileobj=counted(chunks),
+            custom_context=True,
+        )
+        parser = BuildEventParser()
+        self.report = parser.report
+        for idx, chunk in enumerate(output):
+            # The whole context is uploaded before the daemon responds
+            if not idx:
+                parser.report.context_bytes = sent["bytes"]
+                yield ContextSent(sent["bytes"])
+            yield from parser.feed(chunk)
+        yield from parser.close()
+
+    def buildkit_events(self, context, labels=None):
+        """Like build_events, but builds through BuildKit (docker buildx), importing
+        and exporting the layer cache with a local directory, context["buildkit"]
+        """
+        options = context["buildkit"]
+        cache_dir = options["cache_dir"]
+        parser = BuildEventParser()
+        self.report = parser.report
+        driver = buildx_driver(options.get("builder"))
+        if driver == "docker":
+            # Fails only once the image is built, so stop before building at all
+            parser.report.error = (
+                "The buildx builder's docker driver can't export a cache, create "
+                "a builder with: docker buildx create --name bento --driver "
+                "docker-container, then set BUILDX_BUILDER=bento in ENV"
+            )
+            yield BuildError(parser.report.error)
+            return
+        cmd = ["docker", "buildx", "build", "--progress=plain", "--load"]
+        cmd += ["-t", context["tag"]]
+        if options.get("builder"):
+            cmd += ["--builder", options["builder"]]
+        for key, value in (labels or {}).items():
+            cmd += ["--label", f"{key}={value}"]
+        if os.path.isdir(cache_dir):
+            cmd += ["--cache-from", f"type=local,src={cache_dir}"]
+        # Exporting to a fresh directory and swapping it in stops stale layers piling up
+        cmd += ["--cache-to", f"type=local,dest={cache_dir}.new,mode=max"]
+
+        streamed = context.get("fileobj") is not None
+        cmd.append("-" if streamed else context["path"])
+        logging.debug(" ".join(cmd))
+        proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE if streamed else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+
+        sent = {"bytes": 0}
+
+        def feed():
+            try:
+                for chunk in context["fileobj"]:
+                    proc.stdin.write(chunk)
+                    sent["bytes"] += len(chunk)
+            except BrokenPipeError:
+                pass
+            finally:
+                proc.stdin.close()
+
+        if streamed:
+            threading.Thread(target=feed, daemon=True).start()
+        else:
+            ignore = docker_context.read_ignore(f"{context['path']}/.dockerignore")
+            files = docker_context.collect([(context["path"], "")], ignore)
+            sent["bytes"] = sum(os.lstat(path).st_size for path, _ in files)
+
+        for raw in proc.stdout:
+            yield from parser.feed_plain(raw.decode("utf-8", "replace"))
+        code = proc.wait()
+        parser.report.context_bytes = sent["bytes"]
+        yield ContextSent(sent["bytes"])
+        if code and not parser.report.error:
+            parser.report.error = f"docker buildx exited with {code}"
+            yield BuildError(parser.report.error)
+        yield from parser.close()
+        if not code:
+            self.rotate_cache(options)
+
+    def rotate_cache(self, options) -> None:
+        """Swaps in the freshly exported cache, dropping it if it exceeds the size
+        limit, and prunes BuildKit's cache mounts (e.g. pip's) to the same limit
+        """
+        cache_dir, limit_mb = options["cache_dir"], int(options["cache_mb"])
+        if os.path.isdir(f"{cache_dir}.new"):
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            os.rename(f"{cache_dir}.new", cache_dir)
+        size = sum(
+            os.path.getsize(os.path.join(root, fname))
+            for root, _, fnames in os.walk(cache_dir)
+            for fname in fnames
+        )
+        if size > limit_mb * 2 ** 20:
+            logging.info(f"Build cache is {size / 2 ** 20:.0f} MB, starting it over")
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+        cmd = ["docker", "buildx", "prune", "-f", "--filter", "type=exec.cachemount"]
+        cmd += ["--keep-storage", f"{limit_mb}mb"]
+        if options.get("builder"):
+            cmd += ["--builder", options["builder"]]
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
     @logutil.loginfo(level="debug")
+    @tracing.traced()
     def build(self, context, metadata=None):
+        """Builds the image, logging each step and a final report of step timings
+        and cache misses (kept as self.report). Returns 1 on error, else 0.
+        With metadata["stream"], returns the event generator instead.
+        """
         metadata = metadata or {}
-        self.completion = 0
-        self.linebuffer = ""
-        client = docker.APIClient(base_url=self.docksock)
-        output = client.build(decode=True, tag=context["tag"], path=context["path"])
+        self.report = BuildReport()
+
+        # An unchanged context would only reproduce the image we already have
+        digest = context.get("digest")
+        record_file = context.get("record_file")
+        if digest and not metadata.get("force"):
+            if self.is_current(context["tag"], digest, record_file):
+                logging.info(f"Context unchanged for {context['tag']}, skipping build")
+                return 0
+        labels = {DIGEST_LABEL: digest} if digest else None
 
+        if context.get("buildkit"):
+            events = self.buildkit_events(context, labels)
+        else:
+            events = self.build_events(context, labels)
         if metadata.get("stream"):
-            return output
-
-        for chunk in output:
-            result = self.process_output_chunk(chunk)
-        logging.info(self.linebuffer)
-
-        # Return the error code
-        return result["status"]
-
-    def process_output_chunk(self, chunk):
-        msg = {"text": self.linebuffer, "completion": self.completion, "status": 0}
-        if "stream" in chunk:
-            for line in chunk["stream"].splitlines():
-                if "Step" in line:
-                    if self.linebuffer:
-                        logging.info(self.linebuffer)
-                    self.linebuffer = line
-                    match = re.search(r"Step (\d{1,3})\/(\d{1,3})", line)
-                    if match:
-                        num, den = match.groups()
-                        self.completion = int(num) / int(den)
-                        msg = {
-                            "text": self.linebuffer,
-                            "completion": self.completion,
-                            "status": 0,
-                        }
-                elif "cache" in line:
-                    self.linebuffer = "Cached: " + self.linebuffer
-        elif "error" in chunk:
-            logging.warning(chunk["error"])
-            msg = {"text": chunk["error"], "completion": self.completion, "status": 1}
-
-        return msg
+            return events
+
+        for event in events:
+            if isinstance(event, StepFinished):
+                cached = "Cached: " if event.cached else ""
+                logging.info(
+                    f"{cached}Step {event.index}/{event.total} : {event.instruction}"
+                    f" ({event.duration:.1f}s)"
+                )
+            elif isinstance(event, BuildError):
+                logging.warning(event.message)
+        # One line at a time, so long reports aren't truncated by the log formatter
+        for line in self.report.table().splitlines():
+            logging.info(line)
+
+        tracing.add(bytes=self.report.context_bytes)
+        status = 1 if self.report.error else 0
+        if digest and record_file and not status:
+            self.record_build(context["tag"], digest, record_file)
+        return status
+
+    def layers(self, tag) -> list:
+        """(size, instruction) for each layer of the image, newest first"""
+        client = self.client()
+        return [(layer["Size"], layer["CreatedBy"]) for layer in client.history(tag)]
+
+    def image_size(self, tag) -> int:
+        client = self.client()
+        return client.inspect_image(tag)["Size"]
 
     @logutil.loginfo(level="debug")
-    def push(self, tag, metadata=None) -> None:
+    @tracing.traced()
+    def push(self, tags, metadata=None) -> int:
+        """Pushes one or more tags concurrently, e.g. to several registries. Tags other
+        than metadata["source"] are first created from that local image.
+        """
         metadata = metadata or {}
+        tags = [tags] if isinstance(tags, str) else list(tags)
         logging.info("Pushing docker image ...")
-        # os.environ["DOCKER_BUILDKIT"] = "1"
-        client = docker.APIClient(base_url=self.docksock)
-        output = client.push(tag, decode=True, stream=True)
-        if metadata.get("stream"):
-            return output
+        client = self.client()
+        source = metadata.get("source")
+        for tag in tags:
+            if source and tag != source:
+                repository, version = split_tag(tag)
+                client.tag(source, repository, version)
+        if metadata.get("stream") and len(tags) == 1:
+            return client.push(tags[0], decode=True, stream=True)
+
+        progress = PushProgress(mode=metadata.get("progress", "bar"))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(tags)) as pool:
+            errors = list(pool.map(lambda tag: self._push_one(tag, progress), tags))
+        progress.close()
+        tracing.add(bytes=progress.summary()["bytes"])
+        return int(any(errors))
+
+    def _push_one(self, tag, progress) -> bool:
+        """Pushes a single tag on its own client, returning whether it errored"""
+        client = self.client()
+        failed = False
+        for line in client.push(tag, decode=True, stream=True):
+            if "error" in line:
+                logging.warning(f"{tag}: {line['error']}")
+                failed = True
+            else:
+                progress.update(tag, line)
+        return failed
+
 
-        bars = {}
-        for line in output:
-            self.process_push_chunk(line, bars)
+def split_tag(tag):
+    """Splits 'registry:port/name:version' into repository and version"""
+    repository, _, version = tag.rpartition(":")
+    if not repository or "/" in version:
+        return tag, "latest"
+    return repository, version
 
-    def process_push_chunk(self, line, bars):
+
+def buildx_driver(builder=None):
+    """The driver of the buildx builder (e.g. "docker" or "docker-container"), or
+    None if it can't be inspected
+    """
+    cmd = ["docker", "buildx", "inspect"]
+    if builder:
+        cmd += ["--builder", builder]
+    try:
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+    except OSError:
+        return None
+    for line in proc.stdout.splitlines():
+        key, _, value = line.partition(":")
+        if key.strip() == "Driver":
+            return value.strip()
+    return None
+
+
+class PushProgress:
+    """Aggregates push progress of every layer of every tag into a single view,
+    rendered at most once per interval as a bar or as JSON lines (for CI logs).
+    """
+
+    def __init__(self, mode="bar", interval=0.5):
+        self.mode = mode
+        self.interval = interval
+        self.layers = {}
+        self.lock = threading.Lock()
+        self.start = self.last = time.time()
+        self.bar = None
+        if mode == "bar":
+            import tqdm
+
+            self.bar = tqdm.tqdm(
+                total=0, unit="B", unit_scale=True, mininterval=interval, desc="Push"
+            )
+
+    def update(self, tag, line) -> None:
         if "id" not in line:
             return
-        lid = line["id"]
-        status = line["status"]
-        desc = f"{lid}:{status: >24}"
-        if lid in bars:
-            if line["progressDetail"]:
-                try:
-                    total = line["progressDetail"]["total"]
-                    incr = line["progressDetail"]["current"] - bars[lid]["bytes"]
-                    bars[lid]["bar"].update(incr)
-                    bars[lid]["bar"].total = total
-                    bars[lid]["bytes"] += incr
-                except Exception:
-                    logging.warning(f"Can't process line: {line}")
-
-            bars[lid]["bar"].desc = desc
-        else:
-            bars[lid] = {
-                "bar": tqdm.tqdm(range(100), desc=desc),
-                "bytes": 0,
-            }
+        status = line.get("status", "")
+        detail = line.get("progressDetail") or {}
+        with self.lock:
+            layer = self.layers.setdefault(
+                (tag, line["id"]), {"current": 0, "total": 0, "state": "waiting"}
+            )
+            before = layer["current"]
+            if "current" in detail:
+                layer["current"] = detail["current"]
+                layer["total"] = detail.get("total", layer["total"])
+            if status == "Pushed":
+                layer["state"] = "done"
+                layer["current"] = max(layer["current"], layer["total"])
+            elif status == "Layer already exists":
+                layer["state"] = "skipped"
+            elif status == "Pushing":
+                layer["state"] = "pushing"
+            self.render(layer["current"] - before)
+
+    def summary(self) -> dict:
+        states = [layer["state"] for layer in self.layers.values()]
+        sent = sum(layer["current"] for layer in self.layers.values())
+        elapsed = max(time.time() - self.start, 1e-6)
+        return {
+            "bytes": sent,
+            "total": sum(layer["total"] for layer in self.layers.values()),
+            "mb_per_s": round(sent / elapsed / 2 ** 20, 2),
+            "layers": len(states),
+            "done": states.count("done"),
+            "skipped": states.count("skipped"),
+            "elapsed": round(elapsed, 2),
+        }
+
+    def render(self, increment=0, force=False) -> None:
+        # Summing every layer is only worth it once per interval, not per chunk
+        due = force or time.time() - self.last >= self.interval
+        if due:
+            self.last = time.time()
+        if self.bar is not None:
+            if due:
+                summary = self.summary()
+                self.bar.total = max(summary["total"], summary["bytes"])
+                self.bar.set_postfix_str(
+                    f"layers {summary['done']} done, {summary['skipped']} skipped"
+                    f" of {summary['layers']}",
+                    refresh=False,
+                )
+            self.bar.update(increment)
+        elif due:
+            print(json.dumps(self.summary()), flush=True)
+
+    def close(self) -> None:
+        with self.lock:
+            self.render(force=True)
+            if self.bar is not None:
+                self.bar.close()
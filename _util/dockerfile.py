@@ -0,0 +1,110 @@
+"""Generates an app's Dockerfile from the _docker/Dockerfile template, splitting the
+build context into layers ordered by how often they change: extra requirements,
+then data files, then the runtime utilities, then data snapshots, then the
+generated .env/entrypoint, then app code. Editing the app's code then only rebuilds (and pushes) the last,
+small layer.
+"""
+import os
+
+from _util import datacache, tracing
+
+# Line of the template replaced by the generated layers
+MARKER = "# @layers"
+
+# Data files are staged into DATA_DIR and symlinked back into the app directory,
+# so the code layer holds only the (tiny) links
+DATA_DIR = "_data"
+DATA_EXTENSIONS = {
+    ".arrow",
+    ".csv",
+    ".feather",
+    ".gz",
+    ".h5",
+    ".npy",
+    ".npz",
+    ".parquet",
+    ".pkl",
+    ".tsv",
+    ".zip",
+}
+
+
+def data_filter(threshold):
+    """A predicate for data files: known data extensions, or at least threshold bytes"""
+
+    def is_data(path):
+        if os.path.islink(path):
+            return False
+        ext = os.path.splitext(path)[1].lower()
+        return ext in DATA_EXTENSIONS or os.path.getsize(path) >= threshold
+
+    return is_data
+
+
+# The builder's utilities, of which the image gets only those used at runtime
+UTIL_DIR = "_util"
+UTIL_RUNTIME = {"__init__.py", "datacache.py", "logger.py"}
+
+
+def is_runtime_util(path) -> bool:
+    """Whether a file of UTIL_DIR is needed in the image (by the entrypoint)"""
+    return os.path.basename(path) in UTIL_RUNTIME
+
+
+def layers(
+    app,
+    requirements=False,
+    data=False,
+    entrypoint=True,
+    buildkit=False,
+    util=False,
+    snapshots=False,
+):
+    """Dockerfile instructions, least frequently changed first"""
+    lines = []
+    if requirements:
+        # BuildKit can keep pip's download cache across builds in a cache mount
+        pip = (
+            "--mount=type=cache,target=/root/.cache/pip pip3 install"
+            if buildkit
+            else "pip3 install --no-cache-dir"
+        )
+        lines += [
+            "# Extra Python requirements",
+            f"COPY {app}/requirements.txt ./{app}/requirements.txt",
+            f"RUN {pip} -r {app}/requirements.txt",
+        ]
+    if data:
+        lines += [
+            "# Data files (symlinked from the app directory)",
+            f"COPY {DATA_DIR}/ ./{DATA_DIR}/",
+        ]
+    if util:
+        # After the data, so editing the builder never re-pushes the data layer
+        lines += ["# Runtime utilities", f"COPY {UTIL_DIR}/ ./{UTIL_DIR}/"]
+    if snapshots:
+        # Rewritten whenever a loader changes, so kept apart from the raw data
+        snapshot_dir = datacache.SNAPSHOT_DIR
+        lines += ["# Data snapshots", f"COPY {snapshot_dir}/ ./{snapshot_dir}/"]
+    generated = ".env entrypoint.py" if entrypoint else ".env"
+    lines += ["# Generated configuration", f"COPY {generated} ./"]
+    lines += ["# App code", f"COPY {app}/ ./{app}/"]
+    return lines
+
+
+@tracing.traced()
+def generate(template, outfile, app, **kwargs) -> None:
+    """Writes the template to outfile, with the marker line replaced by the layers"""
+    with open(template, "r") as fh:
+        text = fh.read()
+    generated = "\n".join(layers(app, **kwargs))
+    if MARKER not in text:
+        raise ValueError(f"{template} has no '{MARKER}' line to generate layers into")
+    # Replace rather than rewrite, in case the staged copy is linked to the template
+    if os.path.lexists(outfile):
+        os.remove(outfile)
+    with open(outfile, "w") as fh:
+        if kwargs.get("buildkit"):
+            # Cache mounts need the Dockerfile 1.x frontend
+            fh.write("# syntax=docker/dockerfile:1\n")
+        fh.write(text.replace(MARKER, generated))
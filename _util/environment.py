@@ -33,6 +33,26 @@ class ENV_SPEC:
     REGISTRY: str = "local"
     BENTO_PORT: int = 7777
 
+    # Staged files of at least this size are hardlinked/reflinked instead of copied
+    # (0 disables linking)
+    STAGE_LINK_MB: int = 16
+
+    # App files of at least this size (or with a data extension) get their own
+    # image layer, beneath the app code
+    DATA_LAYER_MB: int = 1
+
+    # BuildKit (build.py -k) exports its layer cache here and imports it on later
+    # builds. When the cache outgrows BUILD_CACHE_MB it is started over, and pip's
+    # cache mount is pruned down to the same size
+    BUILD_CACHE_DIR: str = "_build/.buildcache"
+    BUILD_CACHE_MB: int = 4096
+    # Optional buildx builder; exporting cache needs e.g. the docker-container driver
+    BUILDX_BUILDER: str = ""
+
+    # Image size budgets in MB, enforced after build: "800" for every app, or
+    # per app as e.g. "housing=800,simple_example=200,500" (empty disables)
+    IMAGE_BUDGET_MB: str = ""
+
 
 def parse_env_file(env_file: str) -> dict:
     """When not running in a container, the env_file won't be injected, so we need to
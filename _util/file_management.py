@@ -1,20 +1,26 @@
+import errno
 import glob
+import hashlib
+import json
 import os
 import pathlib
 import shutil
-import yaml
 
-from _util import logger, dictutil
+from _util import logger, overlay, tracing
 
 logging = logger.fancy_logger(__name__)
 
 
 def dump(state, path):
+    import yaml  # Deferred, as only some build steps read or write YAML
+
     with open(path, "w") as fh:
         yaml.dump(state, fh, sort_keys=False)
 
 
 def load(filepath, filetype="yaml", key=None):
+    import yaml
+
     with open(filepath, "r") as fh:
         if filetype == "yaml":
             if key:
@@ -22,14 +28,17 @@ def load(filepath, filetype="yaml", key=None):
             return yaml.load(fh, Loader=yaml.Loader)
 
 
-def merge_yaml(filepath1, filepath2, outfile=None, clean=True):
-    """Merge filepath2 keys into filepath1, write to outfile"""
-    outfile = outfile or filepath1
-    combined = dictutil.merge(load(filepath1), load(filepath2))
+@tracing.traced()
+def merge_yaml(*filepaths, outfile=None, clean=True):
+    """Merge the keys of each file into those before it, write to outfile (by
+    default the first file)
+    """
+    outfile = outfile or filepaths[0]
+    combined = overlay.merge(*[overlay.load(path) for path in filepaths])
     if clean:
-        remove(filepath1)
-        remove(filepath2)
-    dump(combined, outfile)
+        for path in filepaths:
+            remove(path)
+    overlay.dump(combined, outfile)
 
 
 def remove(path, ignorable=False):
@@ -55,6 +64,7 @@ def recreate(path):
     create(path)
 
 
+@tracing.traced()
 def copy(src, dest):
     if "*" in src:
         for fname in glob.glob(src):
@@ -64,3 +74,257 @@ def copy(src, dest):
             shutil.copytree(src, dest)
         except NotADirectoryError:
             shutil.copyfile(src, dest)
+
+
+# ioctl request cloning one file's extents into another (FICLONE in linux/fs.h)
+FICLONE = 0x40049409
+
+
+def _reflink(src, dest):
+    """Copy-on-write clone of src, only possible on e.g. btrfs, XFS or APFS"""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(src, "rb") as fin, open(dest, "wb") as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            shutil.copystat(src, dest)
+            return True
+        except OSError:
+            pass
+    os.remove(dest)
+    return False
+
+
+def _copy_range(src, dest):
+    """In-kernel copy, which some filesystems turn into a clone or server-side copy"""
+    with open(src, "rb") as fin, open(dest, "wb") as fout:
+        remaining = os.fstat(fin.fileno()).st_size
+        while remaining > 0:
+            sent = os.copy_file_range(fin.fileno(), fout.fileno(), remaining)
+            if sent == 0:
+                break
+            remaining -= sent
+    shutil.copystat(src, dest)
+
+
+def _clear(path):
+    """Removes whatever is at path, a file, link or (e.g. once a file) a directory"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def _make_parents(path, top):
+    """Creates the directories above path, first clearing any files left where one
+    should go (e.g. once a file, now a directory), up to top
+    """
+    parent = os.path.dirname(path)
+    rel = os.path.relpath(parent, top)
+    if rel != ".":
+        ddir = top
+        for part in rel.split(os.sep):
+            ddir = os.path.join(ddir, part)
+            if os.path.lexists(ddir) and not os.path.isdir(ddir):
+                os.remove(ddir)
+    create(parent)
+
+
+def _prune(path, top):
+    """Removes the directories above path that are now empty, up to top"""
+    parent = os.path.dirname(path)
+    top = os.path.normpath(top)
+    while os.path.normpath(parent) != top and parent.startswith(f"{top}/"):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+
+def stage_file(src, dest, link_threshold=0):
+    """Places src at dest, avoiding a byte copy for files of at least link_threshold
+    bytes by reflinking or hardlinking them. Returns "linked" or "copied".
+    """
+    _clear(dest)
+    size = os.path.getsize(src)
+    if not link_threshold or size < link_threshold:
+        shutil.copy2(src, dest)
+        return "copied"
+
+    if _reflink(src, dest):
+        return "linked"
+    # NOTE A hardlink shares the inode with the source, so never edit staged data
+    try:
+        os.link(src, dest)
+        return "linked"
+    except OSError as exc:
+        if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    if hasattr(os, "copy_file_range"):
+        try:
+            _copy_range(src, dest)
+            return "copied"
+        except OSError:
+            pass
+    shutil.copy2(src, dest)
+    return "copied"
+
+
+# Name of the file, kept at the root of a staging directory, recording what was synced
+MANIFEST = ".stage_manifest.json"
+
+
+@tracing.traced()
+def file_digest(path, chunk_size=1 << 20):
+    """Content hash of a file, read in chunks so large data files stay out of memory"""
+    tracing.add(bytes=os.path.getsize(path))
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(path):
+    try:
+        with open(path, "r") as fh:
+            return json.load(fh)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def dump_manifest(manifest, path):
+    with open(path, "w") as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+
+
+def _walk(src):
+    """Maps each file under src (a directory or a glob) to its path relative to src"""
+    if "*" in src:
+        matches = sorted(glob.glob(src))
+        return {os.path.basename(f): f for f in matches if os.path.isfile(f)}
+    files = {}
+    for root, dirs, fnames in os.walk(src):
+        dirs.sort()
+        for fname in sorted(fnames):
+            path = os.path.join(root, fname)
+            files[os.path.relpath(path, src)] = path
+    return files
+
+
+def _staged(entry, dest):
+    """Whether dest is still the file recorded in the manifest entry"""
+    try:
+        return entry.get("staged") == os.stat(dest).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def known_hashes(root) -> dict:
+    """Content hashes from the manifest still valid for staged and source files"""
+    hashes = {}
+    for key, entry in load_manifest(f"{root}/{MANIFEST}").items():
+        staged = os.path.join(root, key)
+        if _staged(entry, staged):
+            hashes[staged] = entry["hash"]
+        try:
+            src_stat = os.stat(entry["src"])
+        except FileNotFoundError:
+            continue
+        if (src_stat.st_size, src_stat.st_mtime_ns) == (entry["size"], entry["mtime"]):
+            hashes[entry["src"]] = entry["hash"]
+    return hashes
+
+
+@tracing.traced()
+def sync(src, dest, root, link_threshold=0, include=None):
+    """Mirrors src (a directory or a glob) into dest, copying only the files that
+    changed since the manifest kept in the root staging directory was written.
+    Files recorded from src into dest that no longer exist (or are no longer
+    included) are removed. Files of at least link_threshold bytes are linked.
+    """
+    manifest_file = f"{root}/{MANIFEST}"
+    manifest = load_manifest(manifest_file)
+    src_root = os.path.dirname(src) if "*" in src else src
+    dest_prefix = os.path.relpath(dest, root) + "/"
+    stats = {"copied": 0, "linked": 0, "kept": 0, "removed": 0}
+    stats.update({"bytes_copied": 0, "bytes_linked": 0})
+
+    files = {}
+    for rel, path in _walk(src).items():
+        if include and not include(path):
+            continue
+        target = os.path.join(dest, rel)
+        files[os.path.relpath(target, root)] = (path, target)
+
+    # Anything previously synced from src but now gone from it is stale. Removed
+    # first, so a file can take the place of a directory that's gone (or vice versa)
+    for key, entry in list(manifest.items()):
+        if key in files or not entry["src"].startswith(f"{src_root}/"):
+            continue
+        if dest_prefix != "./" and not key.startswith(dest_prefix):
+            continue
+        target = os.path.join(root, key)
+        if os.path.isfile(target) or os.path.islink(target):
+            os.remove(target)
+            _prune(target, dest)
+        del manifest[key]
+        stats["removed"] += 1
+
+    for key, (path, target) in files.items():
+        src_stat = os.stat(path)
+        entry = manifest.get(key, {})
+        staged = _staged(entry, target)
+        if staged and (entry["size"], entry["mtime"]) == (
+            src_stat.st_size,
+            src_stat.st_mtime_ns,
+        ):
+            stats["kept"] += 1
+            continue
+
+        # A touched file with identical content (e.g. git checkout) only needs restat
+        digest = file_digest(path)
+        if staged and entry.get("hash") == digest:
+            stats["kept"] += 1
+        else:
+            _make_parents(target, dest)
+            method = stage_file(path, target, link_threshold)
+            stats[method] += 1
+            stats[f"bytes_{method}"] += src_stat.st_size
+        manifest[key] = {
+            "src": path,
+            "size": src_stat.st_size,
+            "mtime": src_stat.st_mtime_ns,
+            "hash": digest,
+            "staged": os.stat(target).st_mtime_ns,
+        }
+
+    dump_manifest(manifest, manifest_file)
+    tracing.add(bytes=stats["bytes_copied"] + stats["bytes_linked"])
+    logging.debug(f"Synced {src} => {dest}: {stats}")
+    return stats
+
+
+def link_files(rels, target_root, link_root):
+    """Points a relative symlink at link_root/rel to target_root/rel for each rel,
+    and removes any other symlinks found under link_root
+    """
+    rels = set(rels)
+    for rel in rels:
+        link = os.path.join(link_root, rel)
+        target = os.path.relpath(os.path.join(target_root, rel), os.path.dirname(link))
+        if os.path.islink(link) and os.readlink(link) == target:
+            continue
+        if os.path.lexists(link):
+            os.remove(link)
+        create(os.path.dirname(link))
+        os.symlink(target, link)
+
+    for root, _, fnames in os.walk(link_root):
+        for fname in fnames:
+            link = os.path.join(root, fname)
+            if os.path.islink(link) and os.path.relpath(link, link_root) not in rels:
+                os.remove(link)
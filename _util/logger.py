@@ -1,26 +1,118 @@
+import atexit
+import contextvars
+import copy
 import dataclasses
+import json
 import logging
+import logging.handlers
 import os
+import queue
 import sys
+import threading
+
+# Loaded on first use by pformat, as prettyprinter (with its extras) is slow to import
+_pprint = None
+
+
+class _Full(Exception):
+    """Raised by a _BoundedWriter once its budget of lines or characters is spent"""
+
+
+class _BoundedWriter:
+    def __init__(self, max_lines=None, max_chars=None):
+        self.max_lines = max_lines or float("inf")
+        self.max_chars = max_chars or float("inf")
+        self.parts = []
+        self.lines = self.chars = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.lines += text.count("\n")
+        self.chars += len(text)
+        if self.lines > self.max_lines or self.chars > self.max_chars:
+            raise _Full
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+
+def _render(obj, writer) -> None:
+    """Pretty prints obj to writer piece by piece, so a _BoundedWriter can stop the
+    layout as soon as enough has been written
+    """
+    if not hasattr(_pprint, "python_to_sdocs"):
+        _pprint.PrettyPrinter(stream=writer).pprint(obj)
+        return
+    from prettyprinter.sdoctypes import SLine
+
+    for sdoc in _pprint.python_to_sdocs(obj, **_pprint.get_default_config()):
+        if isinstance(sdoc, str):
+            writer.write(sdoc)
+        elif isinstance(sdoc, SLine):
+            writer.write("\n" + " " * sdoc.indent)
+
+
+def _clip(obj, budget):
+    """A copy of nested dicts/lists/tuples holding at most budget[0] items in all,
+    taken in the order they're printed
+    """
+    budget[0] -= 1
+    if isinstance(obj, dict):
+        clipped = {}
+        for key, value in obj.items():
+            if budget[0] <= 0:
+                break
+            clipped[key] = _clip(value, budget)
+        return clipped
+    if type(obj) in (list, tuple):
+        items = []
+        for value in obj:
+            if budget[0] <= 0:
+                break
+            items.append(_clip(value, budget))
+        return type(obj)(items)
+    return obj
+
+
+def pformat(obj, max_lines=None, max_chars=None) -> str:
+    """A pretty printed obj, cut short (and marked so) past max_lines or max_chars"""
+    global _pprint
+    if _pprint is None:
+        # Use prettyprinter for dataclass formatting
+        try:
+            import prettyprinter as pprint
+
+            # NOTE ipython extra has issue, throwing a warning if installed and log a DF
+            # 'ZMQInteractiveShell' object has no attribute 'highlighting_style'
+            pprint.install_extras(exclude=["django", "ipython"], warn_on_error=False)
+
+            # Set a fairly aggressive limit to sequence by default
+            # This makes printing more similar to pandas truncation, which is nice
+            # NOTE However, this doesn't seem to work for big nested structures, so we
+            # might still have to apply a limit on total formatted string lines
+            # TODO Add a way to bypass sequence length when needed
+            pprint.set_default_config(
+                style="dark", max_seq_len=20, width=79, ribbon_width=71, depth=None,
+            )
+        except ImportError:
+            import pprint
+        _pprint = pprint
+    if not max_lines and not max_chars:
+        return _pprint.pformat(obj)
+
+    if max_chars:
+        # Each printed item takes at least 2 characters (e.g. "1,"), so later items
+        # can't show up and needn't be laid out at all
+        obj = _clip(obj, [max_chars // 2])
+    writer = _BoundedWriter(max_lines, max_chars)
+    try:
+        _render(obj, writer)
+    except _Full:
+        lines = writer.getvalue()[:max_chars].splitlines()[:max_lines]
+        lines = [line.rstrip() for line in lines]
+        return "\n".join(lines + [f"...truncated at {len(lines)} lines"])
+    return "\n".join(line.rstrip() for line in writer.getvalue().splitlines())
 
-# Use prettyprinter for dataclass formatting
-try:
-    import prettyprinter as pprint
-
-    # NOTE ipython extra has issue, throwing a warning if installed and log a DF
-    # 'ZMQInteractiveShell' object has no attribute 'highlighting_style'
-    pprint.install_extras(exclude=["django", "ipython"], warn_on_error=False)
-
-    # Set a fairly aggressive limit to sequence by default
-    # This makes printing more similar to pandas truncation, which is nice
-    # NOTE However, this doesn't seem to work for big nested structures, so we
-    # might still have to apply a limit on total formatted string lines
-    # TODO Add a way to bypass sequence length when needed
-    pprint.set_default_config(
-        style="dark", max_seq_len=20, width=79, ribbon_width=71, depth=None,
-    )
-except ImportError:
-    import pprint
 
 # ANSI codes that will generate colored text
 def_color_map = {
@@ -48,9 +140,9 @@ def_level_color = {
 
 # We never truly want infinite output, 1000 lines is probably enough
 config = {
-    "DEBUG": {"max_lines": 1000},
-    "INFO": {"max_lines": 10},
-    "default": {"max_lines": 50},
+    "DEBUG": {"max_lines": 1000, "max_chars": 100000},
+    "INFO": {"max_lines": 10, "max_chars": 2000},
+    "default": {"max_lines": 50, "max_chars": 10000},
 }
 
 formats = {
@@ -61,6 +153,16 @@ formats = {
 }
 
 
+# Optional tag prefixed to messages, e.g. the app being built when running in parallel
+log_context = contextvars.ContextVar("log_context", default="")
+
+
+def _add_context(record):
+    """Handler filter capturing log_context on the thread emitting the record"""
+    record.context = log_context.get()
+    return True
+
+
 # The default schema uses simpler logging for info-level logs, as these are
 # intended for consumption at all times (non-debugging)
 schemas = {
@@ -83,6 +185,8 @@ class FancyFormatter(logging.Formatter):
         # Level colors can also be overridden, if desired
         self.level_color = level_color or def_level_color
         self.color_map = def_color_map
+        # Colored level names, built once per level
+        self.level_strs = {}
 
     def color_text(self, text, color=None):
         """Wraps text in a color code"""
@@ -95,7 +199,44 @@ class FancyFormatter(logging.Formatter):
         return f"{prefix}{text}{suffix}"
 
     def level_fmt(self, level):
-        return self.color_text(f"{level: <8}", self.level_color.get(level))
+        if level not in self.level_strs:
+            color = self.level_color.get(level)
+            self.level_strs[level] = self.color_text(f"{level: <8}", color)
+        return self.level_strs[level]
+
+    def format_json(self, record):
+        """One compact JSON object per record, for log shippers: no colors/macros"""
+        limit = config.get(record.levelname, config["default"])["max_chars"]
+        msg = record.msg
+        if dataclasses.is_dataclass(msg) and not isinstance(msg, type):
+            msg = dataclasses.asdict(msg)
+        if isinstance(msg, (dict, list, tuple)):
+            # Each item takes at least 2 characters, so later ones can't fit anyway
+            budget = [limit // 2]
+            msg = _clip(msg, budget)
+            text = json.dumps(msg, default=str)
+            truncated = budget[0] <= 0 or len(text) > limit
+            if truncated:
+                msg = text[:limit]
+        else:
+            msg = record.getMessage()
+            truncated = len(msg) > limit
+            msg = msg[:limit]
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "name": record.name,
+            "func": record.funcName,
+            "line": record.lineno,
+            "msg": msg,
+        }
+        if truncated:
+            entry["truncated"] = True
+        if getattr(record, "context", ""):
+            entry["context"] = record.context
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, separators=(",", ":")) + "\n"
 
     def format(self, record):
         """Automatically called when logging a record"""
@@ -104,16 +245,19 @@ class FancyFormatter(logging.Formatter):
 
         # Checks for message format in order:  from message, self.fmt, self.schema
         style = record_dict.get("fmt") or self.fmt
+        if style == "json":
+            return self.format_json(record)
         if not style:
             style = self.schema.get(record.levelname, self.schema["default"])
 
-        # Prepare a pretty version of the message
+        # Prepare a pretty version of the message, formatting no more than is shown
         curr_conf = config.get(record.levelname, config["default"])
+        bounds = curr_conf["max_lines"], curr_conf["max_chars"]
 
         if isinstance(record_dict["msg"], (dict, list, tuple)):
-            pretty = pprint.pformat(record_dict["msg"]).strip("'\"")
+            pretty = pformat(record_dict["msg"], *bounds).strip("'\"")
         elif dataclasses.is_dataclass(record_dict["msg"]):
-            pretty = pprint.pformat(record_dict["msg"])
+            pretty = pformat(record_dict["msg"], *bounds)
         else:
             pretty = str(record_dict["msg"])
         total_lines = pretty.count("\n")
@@ -145,14 +289,153 @@ class FancyFormatter(logging.Formatter):
             style = "msg"
         else:
             record_dict["msg"] += "\n"
+        if record_dict.get("context") and style != "msg":
+            record_dict["msg"] = f"[{record_dict['context']}] {record_dict['msg']}"
         message = formats[style].format(**record_dict)
         return message
 
 
-def fancy_logger(name, fmt=None, level=None):
+# Opt-in background logging: records are queued on the logging thread, then
+# formatted and written by a single listener thread (see fancy_logger's queue_size)
+_log_queue = None
+_listener = None
+_queue_lock = threading.Lock()
+_queue_stats = {"dropped": 0, "reported": 0}
+
+
+class _Dispatcher(logging.Handler):
+    """Hands each dequeued record to the stream handler of the logger it came from"""
+
+    def handle(self, record):
+        record.target.handle(record)
+
+
+class _Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Waits for room, so records queued before exit are still written
+        self.queue.put(self._sentinel)
+
+
+# Immutable messages and arguments, safe to format later on another thread
+_PLAIN = (str, int, float, bool, type(None))
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for the listener thread. When the queue is full, overflow
+    decides: "drop" the record, "count" (drop it, and later log how many were
+    dropped) or "block" until there's room.
+    """
+
+    def __init__(self, log_queue, target, overflow="drop"):
+        super().__init__(log_queue)
+        self.target = target
+        self.overflow = overflow
+
+    def prepare(self, record):
+        # Formatting is left to the listener thread, that's the point, but mutable
+        # messages are copied now, as the caller may change them before then
+        record.target = self.target
+        msg, args = record.msg, record.args
+        values = args.values() if isinstance(args, dict) else args or ()
+        if args and not all(isinstance(arg, _PLAIN) for arg in values):
+            try:
+                record.args = copy.deepcopy(args)
+            except Exception:
+                record.msg, record.args = record.getMessage(), None
+        if isinstance(msg, (dict, list, tuple)) or dataclasses.is_dataclass(msg):
+            try:
+                record.msg = copy.deepcopy(msg)
+            except Exception:
+                record.msg = pformat(msg)
+        elif not isinstance(msg, _PLAIN):
+            record.msg = str(msg)
+        return record
+
+    def enqueue(self, record):
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+        missed = 0
+        try:
+            if self.overflow == "count":
+                # Claimed under the lock, so concurrent callers report each drop once
+                with _queue_lock:
+                    missed = _queue_stats["dropped"] - _queue_stats["reported"]
+                    _queue_stats["reported"] += missed
+                if missed:
+                    self.queue.put_nowait(_dropped_notice(record, missed))
+                    missed = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with _queue_lock:
+                # A notice that didn't fit leaves its drops unreported
+                _queue_stats["reported"] -= missed
+                _queue_stats["dropped"] += 1
+                if self.overflow == "count":
+                    _queue_stats["last"] = record
+
+
+def _dropped_notice(record, missed):
+    """A warning, in place of missed records, for the logger record came from"""
+    notice = logging.makeLogRecord(
+        {
+            "name": record.name,
+            "levelno": logging.WARNING,
+            "levelname": "WARNING",
+            "msg": f"{missed} log records dropped, the log queue was full",
+            "funcName": "enqueue",
+            "context": getattr(record, "context", ""),
+        }
+    )
+    notice.target = record.target
+    return notice
+
+
+def queue_stats() -> dict:
+    """Records waiting in the log queue, and dropped because it was full"""
+    waiting = _log_queue.qsize() if _log_queue else 0
+    return {"queued": waiting, "dropped": _queue_stats["dropped"]}
+
+
+def _start_listener(size):
+    """The process-wide log queue, with its listener started on first use"""
+    global _log_queue, _listener
+    with _queue_lock:
+        if _listener is None:
+            # Imports can fail while the interpreter exits, when the listener may
+            # still be formatting, so load the pretty printer up front
+            pformat(None)
+            _log_queue = queue.Queue(maxsize=size)
+            _listener = _Listener(_log_queue, _Dispatcher())
+            _listener.start()
+            atexit.register(_stop_listener)
+    return _log_queue
+
+
+def _stop_listener():
+    """Writes whatever is still queued before the interpreter exits"""
+    _listener.stop()
+    missed = _queue_stats["dropped"] - _queue_stats["reported"]
+    if missed and "last" in _queue_stats:
+        notice = _dropped_notice(_queue_stats["last"], missed)
+        notice.target.handle(notice)
+
+
+def fancy_logger(name, fmt=None, level=None, queue_size=None, overflow=None):
+    """A logger writing to stdout through FancyFormatter. With a queue_size (or
+    LOG_QUEUE_SIZE set), records are written by a background thread, and overflow
+    (or LOG_QUEUE_OVERFLOW) decides what happens when the queue is full
+    """
     env_level = os.environ.get("LOGLEVEL_NAME") or os.environ.get("LOGLEVEL")
+    # E.g. LOG_FORMAT=json for a log shipper, overriding every logger's format
+    fmt = os.environ.get("LOG_FORMAT") or fmt
     if not level:
         level = int(env_level) if env_level else logging.INFO
+    if queue_size is None:
+        queue_size = int(os.environ.get("LOG_QUEUE_SIZE") or 0)
+    overflow = overflow or os.environ.get("LOG_QUEUE_OVERFLOW") or "drop"
+    if overflow not in ("drop", "count", "block"):
+        raise ValueError(f"Log queue overflow must be drop, count or block: {overflow}")
     name_logger = logging.getLogger(name)
     name_logger.setLevel(level)
     name_logger.propagate = False
@@ -161,6 +444,11 @@ def fancy_logger(name, fmt=None, level=None):
         handler = logging.StreamHandler(sys.stdout)
         handler.terminator = ""
         handler.setFormatter(FancyFormatter(fmt=fmt))
+        if queue_size:
+            log_queue = _start_listener(queue_size)
+            handler = BoundedQueueHandler(log_queue, handler, overflow)
+        # Captures the context of the thread logging, not the listener's
+        handler.addFilter(_add_context)
         name_logger.addHandler(handler)
     return name_logger
 
@@ -1,8 +1,10 @@
-import flask
 import functools
 import inspect
+import itertools
 import os
-import traceback
+import sys
+from logging import getLevelName
+
 from _util import logger
 
 # logging = logger.fancy_logger(__name__)
@@ -16,7 +18,14 @@ def _parse_id(func):
     return (func.__module__.split(".")[-1], func.__name__)
 
 
-def loginfo(level="debug", log_route=False):
+def loginfo(level="debug", log_route=False, sample=1):
+    """Logs the arguments and return value of each call, or of 1 in every sample
+    calls. When level is disabled the wrapper only calls through, so it's cheap to
+    leave on hot functions in production.
+    """
+    levelno = getLevelName(level.upper())
+    log = getattr(logging, level)
+
     def inner(func):
         """Wraps class methods to provide automatic log output on args/return value"""
         module, name = _parse_id(func)
@@ -28,16 +37,22 @@ def loginfo(level="debug", log_route=False):
         if arg_names and arg_names[0] in ("self", "cls"):
             class_method = True
             arg_names = arg_names[1:]
+        calls = itertools.count()
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            # Look back in the call stack for the appropriate function
-            stack_idx = -2
-            stack = traceback.extract_stack()
-            lineno = stack[stack_idx].lineno
-            callFunc = stack[stack_idx].name
-            filename = os.path.basename(stack[stack_idx].filename).split(".")[0]
+            if not logging.isEnabledFor(levelno) or (
+                sample > 1 and next(calls) % sample
+            ):
+                return func(*args, **kwargs)
+
+            # Only the frame calling the wrapped function is of interest
+            caller = sys._getframe(1)
+            lineno = caller.f_lineno
+            callFunc = caller.f_code.co_name
+            filename = os.path.basename(caller.f_code.co_filename).split(".")[0]
             msg_base = f"{module}.{name} @ {filename}.{callFunc}:{lineno}"
+            del caller
 
             # Log each argument to the function
             out_args = {}
@@ -47,23 +62,23 @@ def loginfo(level="debug", log_route=False):
             for arg_name, arg_value in zip(arg_names, args[start_idx:]):
                 out_args[arg_name] = arg_value
             out_args.update(kwargs)
-            msg = f"{msg_base} - Input Arguments:"
-            getattr(logging, level)(msg)
-            getattr(logging, level)(out_args)
+            log(f"{msg_base} - Input Arguments:")
+            log(out_args)
 
             # The call itself
             result = func(*args, **kwargs)
 
             # If flagged, also try to log the request object
             if log_route:
+                import flask
+
                 logging.debug(flask.request.json)
 
             # Similarly log the result of the function
             if type(result) in (dict, list, tuple):
                 typename = type(result).__name__
-                msg = f"{msg_base} - Returning {typename} of length {len(result)}"
-                getattr(logging, level)(msg)
-            getattr(logging, level)(result)
+                log(f"{msg_base} - Returning {typename} of length {len(result)}")
+            log(result)
             return result
 
         return wrapper
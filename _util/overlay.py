@@ -0,0 +1,132 @@
+"""Layered YAML configs, such as docker-compose files: a base, then environment and
+per-app overlays. Parsed documents are cached by path and modification time, so
+materializing many apps and environments parses each file only once.
+"""
+import copy
+import itertools
+import os
+
+from _util import logger, tracing
+
+logging = logger.fancy_logger(__name__)
+
+COMPOSE = "docker-compose.yaml"
+# Lists under these keys are replaced by an overlay rather than combined with it
+REPLACE = frozenset({"command", "entrypoint"})
+
+# path => ((mtime, size), document), documents here must never be modified
+_docs = {}
+
+
+def _yaml():
+    """The yaml module with its fastest safe loader and dumper (libyaml, if built)"""
+    import yaml  # Deferred, as only some build steps read or write YAML
+
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+    return yaml, loader, dumper
+
+
+def load(path):
+    """The parsed document at path, shared with other callers, so don't modify it"""
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _docs.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    yaml, loader, _ = _yaml()
+    with open(path, "r") as fh:
+        doc = yaml.load(fh, Loader=loader)
+    _docs[path] = (key, doc)
+    return doc
+
+
+def dump(doc, path):
+    yaml, _, dumper = _yaml()
+    with open(path, "w") as fh:
+        yaml.dump(doc, fh, Dumper=dumper, sort_keys=False)
+
+
+def _union(lists) -> list:
+    """Items of the lists in order, each only once"""
+    output, seen = [], set()
+    for item in itertools.chain.from_iterable(lists):
+        try:
+            if item in seen:
+                continue
+            seen.add(item)
+        except TypeError:
+            # Unhashable, e.g. a mapping in a list of volumes
+            if item in output:
+                continue
+        output.append(copy.deepcopy(item))
+    return output
+
+
+def _merge(values, key=None, replace=REPLACE):
+    last = values[-1]
+    if isinstance(last, dict):
+        kind = dict
+    elif isinstance(last, list) and key not in replace:
+        kind = list
+    else:
+        return copy.deepcopy(last) if isinstance(last, (dict, list)) else last
+
+    # Layers before one of another kind are overridden by it entirely
+    run = list(itertools.takewhile(lambda value: isinstance(value, kind), values[::-1]))
+    run.reverse()
+    if kind is list:
+        return _union(run)
+    keyed = {}
+    for layer in run:
+        for sub_key, value in layer.items():
+            keyed.setdefault(sub_key, []).append(value)
+    return {sub_key: _merge(vals, sub_key, replace) for sub_key, vals in keyed.items()}
+
+
+@tracing.traced()
+def merge(*layers, replace=REPLACE) -> dict:
+    """Merges the layers into a new dict, later layers overriding earlier ones.
+    Nested dicts are merged, lists are combined without duplicates (unless under a
+    key in replace) and anything else is replaced. The layers aren't modified.
+    """
+    layers = [layer for layer in layers if layer is not None]
+    return _merge(layers or [{}], replace=replace)
+
+
+def layer_paths(app, env=None, name=COMPOSE, base="_docker") -> list:
+    """Existing layers for an app in an environment, in merge order. An environment
+    such as "prod-eu" is layered as "prod", then "prod-eu", e.g.:
+
+        _docker/docker-compose.yaml, housing/docker-compose.yaml,
+        _docker/prod-docker-compose.yaml, housing/prod-docker-compose.yaml,
+        _docker/prod-eu-docker-compose.yaml, housing/prod-eu-docker-compose.yaml
+    """
+    parts = env.split("-") if env else []
+    prefixes = [""] + ["-".join(parts[: idx + 1]) + "-" for idx in range(len(parts))]
+    paths = [
+        f"{ddir}/{prefix}{name}" for prefix in prefixes for ddir in (base, app) if ddir
+    ]
+    return [path for path in paths if os.path.isfile(path)]
+
+
+def compose(app, env=None, name=COMPOSE, base="_docker") -> dict:
+    """The app's merged config for the environment"""
+    return merge(*[load(path) for path in layer_paths(app, env, name, base)])
+
+
+@tracing.traced()
+def materialize(apps, envs, outdir=None, name=COMPOSE, base="_docker") -> dict:
+    """Merged configs for every app and environment, keyed by (app, env). With an
+    outdir, each is also written to e.g. outdir/housing/prod-docker-compose.yaml
+    (an env of None or "" meaning just the base layers).
+    """
+    configs = {}
+    for app, env in itertools.product(apps, envs):
+        configs[(app, env)] = compose(app, env, name, base)
+        if outdir:
+            os.makedirs(f"{outdir}/{app}", exist_ok=True)
+            prefix = f"{env}-" if env else ""
+            dump(configs[(app, env)], f"{outdir}/{app}/{prefix}{name}")
+    logging.debug(f"Materialized {len(configs)} configs from {len(_docs)} files")
+    return configs
@@ -0,0 +1,149 @@
+"""A small dependency-graph scheduler for the build steps. Each step names the
+resources it needs and the ones it provides, and steps whose inputs are ready
+run concurrently on threads.
+"""
+import concurrent.futures
+import contextvars
+import json
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Tuple
+
+from _util import logger, tracing
+
+logging = logger.fancy_logger(__name__)
+
+# Timings of several apps may be saved concurrently
+_timings_lock = threading.Lock()
+
+
+@dataclass
+class Step:
+    func: Callable
+    inputs: Tuple[str, ...] = ()
+    outputs: Tuple[str, ...] = ()
+    # Foreground steps (chdir, interactive use) run alone on the calling thread
+    foreground: bool = False
+
+    @property
+    def name(self):
+        return self.func.__name__
+
+
+def resolve(steps) -> dict:
+    """Maps each step name to the names of the steps it must wait for. Inputs are
+    provided by earlier steps only, so declaration order breaks any cycle.
+    """
+    deps = {}
+    for idx, step in enumerate(steps):
+        earlier = steps[:idx]
+        needs = set(step.inputs)
+        deps[step.name] = {
+            prior.name
+            for prior in earlier
+            if step.foreground or prior.foreground or needs & set(prior.outputs)
+        }
+    return deps
+
+
+def critical_path(steps, deps, durations) -> tuple:
+    """The longest chain of dependent steps, weighted by durations in seconds"""
+    finish, via = {}, {}
+    for step in steps:
+        prior = max(deps[step.name], key=lambda name: finish[name], default=None)
+        start = finish[prior] if prior else 0.0
+        finish[step.name] = start + durations.get(step.name, 0.0)
+        via[step.name] = prior
+    name = max(finish, key=finish.get, default=None)
+    total = finish.get(name, 0.0)
+    path = []
+    while name:
+        path.insert(0, name)
+        name = via[name]
+    return path, total
+
+
+def plan(steps, durations=None) -> str:
+    """Describes the resolved graph and its critical path, using prior durations"""
+    durations = durations or {}
+    deps = resolve(steps)
+    lines = []
+    for step in steps:
+        after = ", ".join(sorted(deps[step.name])) or "-"
+        known = durations.get(step.name)
+        took = f"{known:7.2f}s" if known is not None else "      ?"
+        flag = " (foreground)" if step.foreground else ""
+        lines.append(f"{step.name: <20}{took}  after: {after}{flag}")
+    if not any(step.name in durations for step in steps):
+        lines.append("Critical path: unknown, no step timings recorded yet")
+        return "\n".join(lines)
+    path, total = critical_path(steps, deps, durations)
+    lines.append(f"Critical path ({total:.2f}s): {' -> '.join(path)}")
+    return "\n".join(lines)
+
+
+def _timed(func, build_args):
+    start = time.time()
+    with tracing.span(func.__name__):
+        func(build_args)
+    return time.time() - start
+
+
+def run(steps, build_args, workers=4) -> dict:
+    """Runs the steps as their dependencies complete, returning their durations.
+    The first failure stops new steps from starting and is re-raised.
+    """
+    deps = resolve(steps)
+    pending = list(steps)
+    durations, running = {}, {}
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            ready = [s for s in pending if deps[s.name] <= durations.keys()]
+            for step in ready if not error else []:
+                if step.foreground:
+                    # Only once nothing else is in flight
+                    if running:
+                        continue
+                    pending.remove(step)
+                    durations[step.name] = _timed(step.func, build_args)
+                    break
+                pending.remove(step)
+                # Carries context (e.g. the app log prefix) into the worker thread
+                ctx = contextvars.copy_context()
+                future = pool.submit(ctx.run, _timed, step.func, build_args)
+                running[future] = step
+            if error and not running:
+                break
+            if not running:
+                continue
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                step = running.pop(future)
+                try:
+                    durations[step.name] = future.result()
+                except BaseException as exc:
+                    logging.error(f"Step {step.name} failed: {exc!r}")
+                    error = error or exc
+    if error:
+        raise error
+    return durations
+
+
+def load_timings(path) -> dict:
+    try:
+        with open(path, "r") as fh:
+            return json.load(fh)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_timings(path, key, durations) -> None:
+    with _timings_lock:
+        timings = load_timings(path)
+        timings[key] = durations
+        with open(path, "w") as fh:
+            json.dump(timings, fh, indent=1, sort_keys=True)
@@ -0,0 +1,70 @@
+"""Summarizes what a build context (and the image built from it) is made of, so
+unexpectedly large or accidental files are caught before they slow every pull.
+"""
+import fnmatch
+import os
+
+from _util import docker_context
+
+# Files that rarely belong in an image: caches, editor/OS litter, dumps and logs
+ACCIDENTAL = [
+    "**/__pycache__",
+    "**/*.py[co]",
+    "**/.ipynb_checkpoints",
+    "**/.pytest_cache",
+    "**/.mypy_cache",
+    "**/.git",
+    "**/node_modules",
+    "**/.DS_Store",
+    "**/*.swp",
+    "**/*.tmp",
+    "**/*.bak",
+    "**/*.log",
+    "**/*.dump",
+    "**/*.hprof",
+]
+# Core dumps, matched on file names alone, as a directory (package) named core is fine
+ACCIDENTAL_NAMES = ["core", "core.[0-9]*"]
+
+
+def context_report(files, top=10) -> dict:
+    """Total size, the largest files and any accidental-looking files of a context,
+    given as (path, arcname) pairs such as docker_context.collect returns
+    """
+    sizes = [(arcname, os.lstat(path).st_size) for path, arcname in files]
+    suspicious = []
+    for arcname, size in sizes:
+        name = os.path.basename(arcname)
+        for pattern in ACCIDENTAL + ACCIDENTAL_NAMES:
+            if pattern in ACCIDENTAL_NAMES:
+                matched = fnmatch.fnmatchcase(name, pattern)
+            else:
+                matched = docker_context.excluded(arcname, [pattern])
+            if matched:
+                suspicious.append((arcname, size, pattern))
+                break
+    return {
+        "total": sum(size for _, size in sizes),
+        "largest": sorted(sizes, key=lambda item: -item[1])[:top],
+        "suspicious": suspicious,
+    }
+
+
+def budget_mb(spec, app):
+    """Reads a budget spec such as "800" or "housing=800,simple_example=200,500":
+    app=MB entries apply to one app, a bare number to every other app
+    """
+    default = None
+    for entry in (spec or "").split(","):
+        name, _, value = entry.strip().rpartition("=")
+        if not value:
+            continue
+        if name == app:
+            return float(value)
+        elif not name:
+            default = float(value)
+    return default
+
+
+def mb(size) -> str:
+    return f"{size / 2 ** 20:8.1f} MB"
@@ -0,0 +1,111 @@
+"""Opt-in, nested timing spans for the build pipeline, saved in the Chrome trace
+event format, so a build can be opened in chrome://tracing or ui.perfetto.dev.
+Until start() is called, spans and traced functions cost a single check.
+"""
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+# Completed events, or None while tracing is off
+_events = None
+_lock = threading.Lock()
+_local = threading.local()
+_thread_names = {}
+
+
+def start() -> None:
+    global _events
+    _events = []
+
+
+def enabled() -> bool:
+    return _events is not None
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def add(**args) -> None:
+    """Adds (or, for numbers, accumulates) arguments such as bytes moved to the
+    innermost open span of the calling thread
+    """
+    if _events is None or not _stack():
+        return
+    span_args = _stack()[-1]
+    for key, value in args.items():
+        if isinstance(value, (int, float)) and key in span_args:
+            span_args[key] += value
+        else:
+            span_args[key] = value
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    """Records the wall and CPU time of the block as one complete event"""
+    if _events is None:
+        yield
+        return
+    stack = _stack()
+    stack.append(dict(args))
+    start_wall, start_cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        span_args = stack.pop()
+        span_args["cpu_ms"] = round((time.thread_time() - start_cpu) * 1e3, 3)
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": start_wall * 1e6,
+            "dur": (time.perf_counter() - start_wall) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": span_args,
+        }
+        with _lock:
+            _events.append(event)
+            _thread_names[event["tid"]] = threading.current_thread().name
+
+
+def traced(name=None):
+    """Decorator wrapping each call of the function in a span"""
+
+    def inner(func):
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _events is None:
+                return func(*args, **kwargs)
+            with span(label):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return inner
+
+
+def save(path) -> None:
+    """Writes the recorded events, naming each thread for the trace viewer"""
+    with _lock:
+        events = list(_events or [])
+        names = dict(_thread_names)
+    tids = {event["tid"] for event in events}
+    meta = [
+        {
+            "name": "thread_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": {"name": names.get(tid, str(tid))},
+        }
+        for tid in tids
+    ]
+    with open(path, "w") as fh:
+        json.dump({"traceEvents": meta + events, "displayTimeUnit": "ms"}, fh)
@@ -1,51 +1,130 @@
+import ast
 import glob
-import importlib
+import importlib.machinery
+import json
 import os
 import sys
+import threading
 
-from _util import logger
+from _util import logger, tracing
 
 logging = logger.fancy_logger(__name__)
 
+# App discovery results and version files are cached, and version files are
+# rewritten, so serialize both
+_lock = threading.Lock()
 
-def test_app_names() -> bool:
-    """Checks if the user-defined app name is already an importable Python module"""
+
+def load_cache(cache_file) -> dict:
+    try:
+        with open(cache_file, "r") as fh:
+            return json.load(fh)
+    except (TypeError, FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_cache(cache, cache_file) -> None:
+    if not cache_file:
+        return
+    os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+    tmp_file = f"{cache_file}.tmp"
+    with open(tmp_file, "w") as fh:
+        json.dump(cache, fh, indent=1, sort_keys=True)
+    os.replace(tmp_file, cache_file)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _search_path() -> list:
+    """sys.path without the working directory, where the apps themselves live"""
     cwd = os.getcwd()
-    while "" in sys.path:
-        sys.path.remove("")
-    while cwd in sys.path:
-        sys.path.remove(cwd)
+    return [path for path in sys.path if path not in ("", cwd)]
 
-    for app in [appdir[:-1] for appdir in glob.glob("[a-z]*/")]:
+
+def _module_location(name, path) -> str:
+    """Where a top-level module would be imported from, found without importing or
+    executing it ("" if it isn't importable)
+    """
+    for finder in sys.meta_path:
+        find_spec = getattr(finder, "find_spec", None)
+        if not find_spec:
+            continue
         try:
-            importlib.import_module(f"{app}")
-            logging.warning(
-                f"Name '{app}' intersects with a Python module, try a new one"
-            )
-            flag = True
-        except ModuleNotFoundError:
-            flag = False
-        except Exception:
-            logging.info(f"Module {app} found but import failed")
+            if finder is importlib.machinery.PathFinder:
+                spec = find_spec(name, path)
+            else:
+                spec = find_spec(name, None)
+        except (ImportError, ValueError):
+            continue
+        if spec:
+            # Namespace packages have search locations rather than an origin
+            return spec.origin or ", ".join(spec.submodule_search_locations)
+    return ""
+
+
+def test_app_names(cache=None) -> bool:
+    """Checks if the user-defined app name is already an importable Python module.
+    Results are kept in cache until a directory on the search path changes.
+    """
+    cache = {} if cache is None else cache
+    path = _search_path()
+    # Installing or removing a package touches its directory on the search path
+    path_key = [[entry, _mtime(entry)] for entry in path]
+    if cache.get("search_path") != path_key:
+        cache["search_path"], cache["clashes"] = path_key, {}
+
+    flag = False
+    for app in [appdir[:-1] for appdir in glob.glob("[a-z]*/")]:
+        if app not in cache["clashes"]:
+            cache["clashes"][app] = _module_location(app, path)
+        if cache["clashes"][app]:
+            logging.debug(f"Module {app} found at {cache['clashes'][app]}")
             logging.warning(
                 f"Name '{app}' intersects with a Python module, try a new one"
             )
             flag = True
-
-    sys.path.insert(0, cwd)
     return flag
 
 
-def parse_versions() -> dict:
-    """Grabs version string from each app's _version.py"""
+def read_version(version_file) -> str:
+    """The __version__ string assigned in a _version.py, parsed without running it"""
+    with open(version_file, "r") as fh:
+        tree = ast.parse(fh.read(), filename=version_file)
+    for node in tree.body:
+        if not isinstance(node, ast.Assign):
+            continue
+        if any(getattr(target, "id", "") == "__version__" for target in node.targets):
+            try:
+                # literal_eval, as Python 3.7 parses strings as ast.Str, not Constant
+                version = ast.literal_eval(node.value)
+            except ValueError:
+                continue
+            if isinstance(version, str):
+                return version
+    raise ValueError(f"No __version__ string in {version_file}")
+
+
+def parse_versions(cache=None) -> dict:
+    """Grabs version string from each app's _version.py, reparsing only files whose
+    modification time differs from the cached one
+    """
+    cache = {} if cache is None else cache
+    cached = cache.setdefault("versions", {})
     versions = {}
     for app in [appdir[:-1] for appdir in glob.glob("[a-z]*/")]:
-        try:
-            version_module = importlib.import_module(f"{app}._version")
-            versions[app] = version_module.__version__
-        except ModuleNotFoundError:
+        version_file = f"{app}/_version.py"
+        mtime = _mtime(version_file)
+        if mtime is None:
             logging.warning(f"No _version.py file for {app}")
-            pass
+            continue
+        if cached.get(app, {}).get("mtime") != mtime:
+            cached[app] = {"mtime": mtime, "version": read_version(version_file)}
+        versions[app] = cached[app]["version"]
 
     logging.debug(versions)
     return versions
@@ -101,14 +180,25 @@ def write_update(versions: dict, app: str) -> None:
         fh.write(f"""{versions[app]}\n""")
 
 
-def get_version(app: str) -> str:
-    test_app_names()
-    versions = parse_versions()
+@tracing.traced()
+def get_version(app: str, cache_file=None) -> str:
+    with _lock:
+        cache = load_cache(cache_file)
+        test_app_names(cache)
+        versions = parse_versions(cache)
+        save_cache(cache, cache_file)
     return versions.get(app, "0.0.0")
 
 
-def release(app: str, level: str = "patch") -> str:
-    versions = parse_versions()
-    bump_version(versions, app, level)
-    write_update(versions, app)
+@tracing.traced()
+def release(app: str, level: str = "patch", cache_file=None) -> str:
+    with _lock:
+        cache = load_cache(cache_file)
+        versions = parse_versions(cache)
+        bump_version(versions, app, level)
+        write_update(versions, app)
+        # Coarse file timestamps may not change between a read and this rewrite
+        mtime = _mtime(f"{app}/_version.py")
+        cache["versions"][app] = {"mtime": mtime, "version": versions[app]}
+        save_cache(cache, cache_file)
     return versions[app]
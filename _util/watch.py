@@ -0,0 +1,175 @@
+"""Watches source files for changes, so a running dev server's staged copy can be
+kept up to date. Uses Linux inotify (through ctypes, no extra packages) and falls
+back to polling modification times where inotify isn't available.
+"""
+import ctypes
+import ctypes.util
+import fnmatch
+import glob
+import os
+import select
+import struct
+import time
+
+from _util import logger
+
+logging = logger.fancy_logger(__name__)
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+)
+EVENT = struct.Struct("iIII")
+
+
+def _libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError, TypeError):
+        return None
+    return libc
+
+
+class Watcher:
+    """Reports changed paths under dirs (recursively), and paths matching patterns
+    such as "ENV*" (in their directory only). Paths are given as they were passed in,
+    e.g. relative to the working directory.
+
+        with Watcher(["housing", "_docker"], ["ENV*"]) as watcher:
+            while True:
+                changed = watcher.poll()
+    """
+
+    def __init__(self, dirs=(), patterns=(), interval=0.5, settle=0.05):
+        self.dirs = [os.path.normpath(ddir) for ddir in dirs]
+        self.patterns = [os.path.normpath(pattern) for pattern in patterns]
+        # Polling period, and how long to wait for a burst of events to finish
+        self.interval = interval
+        self.settle = settle
+        self.fd = None
+        self.wds = {}
+        libc = _libc()
+        if libc:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.libc, self.fd = libc, fd
+        if self.fd is None:
+            logging.debug("inotify unavailable, polling for changes")
+            self.snapshot = self._scan()
+            return
+        for ddir in self.dirs:
+            self._watch_tree(ddir)
+        for parent in {os.path.dirname(pattern) or "." for pattern in self.patterns}:
+            self._watch(parent)
+
+    @property
+    def backend(self) -> str:
+        return "polling" if self.fd is None else "inotify"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _watch(self, path) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            # E.g. the directory is already gone, or fs.inotify.max_user_watches
+            error = os.strerror(ctypes.get_errno())
+            logging.warning(f"Can't watch {path}: {error}")
+            return
+        self.wds[wd] = path
+
+    def _watch_tree(self, top) -> None:
+        for root, _, _ in os.walk(top):
+            self._watch(root)
+
+    def _wanted(self, path) -> bool:
+        under = any(path == ddir or path.startswith(f"{ddir}/") for ddir in self.dirs)
+        return under or any(fnmatch.fnmatch(path, pat) for pat in self.patterns)
+
+    def _read(self) -> set:
+        changed = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so report everything as changed
+                logging.warning("Watch queue overflowed, rescanning")
+                return set(self.dirs) | set(self.patterns)
+            if wd not in self.wds:
+                continue
+            path = os.path.normpath(os.path.join(self.wds[wd], os.fsdecode(name)))
+            if not self._wanted(path):
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # inotify isn't recursive, new directories need watches of their own
+                self._watch_tree(path)
+            changed.add(path)
+        return changed
+
+    def _scan(self) -> dict:
+        snapshot = {}
+        paths = [glob.glob(pattern) for pattern in self.patterns]
+        for ddir in self.dirs:
+            for root, _, fnames in os.walk(ddir):
+                paths.append([os.path.join(root, fname) for fname in fnames])
+        for path in [path for group in paths for path in group]:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def poll(self, timeout=None) -> set:
+        """Blocks until something changes (or timeout seconds pass, returning an
+        empty set), then returns the changed paths
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.fd is None:
+                changed = self._poll_scan()
+            else:
+                wait = None if deadline is None else max(0, deadline - time.monotonic())
+                ready, _, _ = select.select([self.fd], [], [], wait)
+                changed = self._read() if ready else set()
+                # Editors often write a file in several steps, report them together
+                while changed and select.select([self.fd], [], [], self.settle)[0]:
+                    changed |= self._read()
+            if changed or (deadline and time.monotonic() >= deadline):
+                return changed
+
+    def _poll_scan(self) -> set:
+        time.sleep(self.interval)
+        snapshot = self._scan()
+        before, self.snapshot = self.snapshot, snapshot
+        return {
+            path
+            for path in before.keys() | snapshot.keys()
+            if before.get(path) != snapshot.get(path)
+        }
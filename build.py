@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import copy
 import fileinput
 import glob
 import os
 import subprocess
 import sys
+import threading
+import time
 
-from _util import versioning, environment
+from _util import datacache, docker_context, dockerfile, pipeline, size_report
+from _util import overlay, tracing, versioning, environment, watch
 from _util import file_management as FM
 from _util.docker_manager import DockerManager
 
@@ -18,8 +23,8 @@ except ImportError:
     import logging
 
 
-def run_command(cmd):
-    proc = subprocess.Popen(cmd)
+def run_command(cmd, cwd=None):
+    proc = subprocess.Popen(cmd, cwd=cwd)
     try:
         logging.info(f"Running {' '.join(cmd)}")
         logging.debug(cmd)
@@ -31,36 +36,137 @@ def run_command(cmd):
 
 
 def tag(build_args):
+    cache_file = f"{build_args.build_dir}/.versions.json"
     if build_args.release in ("major", "minor", "patch", "revert"):
-        version = versioning.release(build_args.app, level=build_args.release)
+        version = versioning.release(build_args.app, build_args.release, cache_file)
     else:
-        version = versioning.get_version(build_args.app)
+        version = versioning.get_version(build_args.app, cache_file)
     build_args.version = version
     state = "" if not build_args.dev else "dev"
     build_args.tag = f"{build_args.env.REGISTRY}/{build_args.app}:{version}{state}"
     logging.info(f"Setting build tag to {build_args.tag}")
 
+    # Every registry gets the version tag, and "latest" too if requested
+    registries = [build_args.env.REGISTRY] + build_args.registries
+    versions = [f"{version}{state}"] + ([f"latest{state}"] if build_args.latest else [])
+    build_args.push_tags = [
+        f"{registry}/{build_args.app}:{v}" for registry in registries for v in versions
+    ]
+
 
 def prepare_stage(build_args):
     logging.info(f"Preparing staging directory: {build_args.stg_dir}")
-    # Completely clean prior build and recreate with source code
-    FM.recreate(build_args.stg_dir)
-    FM.copy(f"{build_args.app}", f"{build_args.stg_dir}/{build_args.app}")
+    # Without a manifest we can't tell what's stale, so clean and start from scratch
+    manifest = f"{build_args.stg_dir}/{FM.MANIFEST}"
+    if build_args.clean or not os.path.exists(manifest):
+        FM.recreate(build_args.stg_dir)
+
+    # A streamed build context reads the app straight from its source directory
+    if not build_args.stream or build_args.execute:
+        stats = stage_app(build_args)
+        logging.info(
+            f"Staged {build_args.app}: {stats['copied']} copied "
+            f"({stats['bytes_copied'] / 2 ** 20:.1f} MB), {stats['linked']} linked "
+            f"({stats['bytes_linked'] / 2 ** 20:.1f} MB), "
+            f"{stats['kept']} unchanged, {stats['removed']} removed"
+        )
+    link_data(build_args)
+
+
+def stage_app(build_args) -> dict:
+    """Syncs the app's data and code into staging, returning FM.sync's stats"""
+    app, stg_dir = build_args.app, build_args.stg_dir
+    data_dir = f"{stg_dir}/{dockerfile.DATA_DIR}/{app}"
+    link_threshold = int(float(build_args.env.STAGE_LINK_MB) * 2 ** 20)
+    is_data = data_filter(build_args)
+    stats = FM.sync(app, data_dir, stg_dir, link_threshold, include=is_data)
+    code_stats = FM.sync(
+        app,
+        f"{stg_dir}/{app}",
+        stg_dir,
+        link_threshold,
+        include=lambda path: not is_data(path),
+    )
+    for key, value in code_stats.items():
+        stats[key] += value
+    return stats
+
+
+def link_data(build_args) -> None:
+    # Data files get their own image layer, so they're symlinked into the app
+    app, stg_dir = build_args.app, build_args.stg_dir
+    data_dir = f"{stg_dir}/{dockerfile.DATA_DIR}/{app}"
+    FM.link_files(data_files(build_args), data_dir, f"{stg_dir}/{app}")
+
+
+def data_filter(build_args):
+    threshold = int(float(build_args.env.DATA_LAYER_MB) * 2 ** 20)
+    return dockerfile.data_filter(threshold)
+
+
+def data_files(build_args) -> list:
+    """Paths of the app's data files, relative to the app directory"""
+    is_data = data_filter(build_args)
+    app_files = docker_context.collect([(build_args.app, "")])
+    return [arcname for path, arcname in app_files if is_data(path)]
+
+
+def snapshot_data(build_args) -> None:
+    """Runs the app's data modules, saving what their load() returns as snapshots
+    for their own image layer, which the entrypoint prefers at startup
+    """
+    # Run from source, where paths such as housing/... are as they are under /app,
+    # so it doesn't depend on what's staged (nothing of the app, when streaming)
+    sources = [f"{build_args.app}/{rel}" for rel in data_files(build_args)]
+    cmd = [sys.executable, "-m", "_util.datacache", build_args.app]
+    cmd += ["--cache_dir", snapshot_dir(build_args), "--sources", *sources]
+    # Keeps the imports from writing __pycache__ into the app's source
+    env = {**os.environ, "PYTHONDONTWRITEBYTECODE": "1"}
+    proc = subprocess.run(cmd, env=env)
+    if proc.returncode:
+        # Not fatal: without a snapshot, containers run load() as before
+        logging.warning("Couldn't snapshot every data module, see above")
+
+
+def snapshot_dir(build_args) -> str:
+    return f"{build_args.stg_dir}/{datacache.SNAPSHOT_DIR}"
 
 
 def add_docker(build_args):
     logging.debug(f"Adding docker materials: _docker/* => {build_args.stg_dir}")
-    FM.copy("_docker/*", build_args.stg_dir)
-    compose = f"{build_args.stg_dir}/docker-compose.yaml"
-    dev_compose = f"{build_args.stg_dir}/dev-docker-compose.yaml"
-    if build_args.dev:
-        try:
-            FM.merge_yaml(compose, dev_compose, outfile=dev_compose)
-            FM.remove(compose, ignorable=True)
-        except FileNotFoundError:
-            logging.info(f"Couldn't merge docker-compose and dev-docker-compose")
-    else:
-        FM.remove(dev_compose, ignorable=True)
+    util_dir = f"{build_args.stg_dir}/{dockerfile.UTIL_DIR}"
+    FM.sync(
+        dockerfile.UTIL_DIR,
+        util_dir,
+        build_args.stg_dir,
+        include=dockerfile.is_runtime_util,
+    )
+    FM.sync("_docker", build_args.stg_dir, build_args.stg_dir, include=is_material)
+    dockerfile.generate(
+        "_docker/Dockerfile",
+        f"{build_args.stg_dir}/Dockerfile",
+        build_args.app,
+        requirements=os.path.exists(f"{build_args.app}/requirements.txt"),
+        data=bool(data_files(build_args)),
+        entrypoint=os.path.exists(f"{build_args.entrypoint}.py"),
+        buildkit=build_args.buildkit,
+        util=os.path.isdir(dockerfile.UTIL_DIR),
+        snapshots=os.path.isdir(snapshot_dir(build_args)),
+    )
+    # The base docker-compose.yaml, then any dev- and app overlays
+    env = "dev" if build_args.dev else None
+    layers = overlay.layer_paths(build_args.app, env)
+    logging.debug(f"    compose layers: {', '.join(layers)}")
+    compose = f"{build_args.stg_dir}/{overlay.COMPOSE}"
+    dev_compose = f"{build_args.stg_dir}/dev-{overlay.COMPOSE}"
+    FM.remove(compose if build_args.dev else dev_compose, ignorable=True)
+    merged = overlay.merge(*[overlay.load(path) for path in layers])
+    overlay.dump(merged, dev_compose if build_args.dev else compose)
+
+
+def is_material(path) -> bool:
+    # Compose files are layers, merged by add_docker rather than staged as they are
+    return not path.endswith(overlay.COMPOSE)
 
 
 def env_file(build_args):
@@ -99,32 +205,148 @@ def prepare_entrypoint(build_args):
 
 def execute(build_args):
     os.environ["APP"] = build_args.app
-    os.chdir(build_args.stg_dir)
-    run_command(["python3", f"{build_args.entrypoint}.py"])
+    if build_args.watch:
+        thread = threading.Thread(target=watch_stage, args=(build_args,), daemon=True)
+        thread.start()
+    # Runs in staging, while we stay put to keep syncing it from source
+    run_command(["python3", f"{build_args.entrypoint}.py"], cwd=build_args.stg_dir)
     finish(None)
 
 
+def restage(build_args, changed) -> None:
+    """Brings staging up to date with the changed source paths, regenerating only
+    the artifacts they affect
+    """
+    app = os.path.normpath(build_args.app)
+    if any(path == app or path.startswith(f"{app}/") for path in changed):
+        stage_app(build_args)
+        link_data(build_args)
+    docker_paths = ("_docker", dockerfile.UTIL_DIR)
+    if any(
+        path.startswith(docker_paths) or path.endswith(overlay.COMPOSE)
+        for path in changed
+    ):
+        add_docker(build_args)
+    if any(path.startswith("ENV") for path in changed):
+        env_file(build_args)
+    if f"{build_args.entrypoint}.py" in changed:
+        prepare_entrypoint(build_args)
+
+
+def watch_stage(build_args) -> None:
+    """Re-syncs staging whenever the app, _docker, _util, ENV files or entrypoint
+    change
+    """
+    entrypoint = f"{build_args.entrypoint}.py"
+    dirs = [build_args.app, "_docker", dockerfile.UTIL_DIR]
+    with watch.Watcher(dirs, ["ENV*", entrypoint]) as watcher:
+        logging.info(f"Watching {build_args.app} for changes ({watcher.backend})")
+        while True:
+            changed = watcher.poll()
+            start = time.time()
+            try:
+                restage(build_args, changed)
+            except Exception as exc:
+                logging.error(f"Re-staging failed: {exc!r}")
+                continue
+            took = (time.time() - start) * 1e3
+            logging.info(f"Synced {len(changed)} changed paths in {took:.0f} ms")
+
+
 def finish(build_args, *args):
-    sys.exit()
+    sys.exit(*args)
+
+
+def context_sources(build_args) -> list:
+    """Where each part of the build context comes from, for streaming it from source.
+    Mirrors the staged layout: data under _data/, symlinked from the app directory.
+    """
+    app, stg_dir = build_args.app, build_args.stg_dir
+    is_data = data_filter(build_args)
+    return [
+        ("_docker", "", is_material),
+        (dockerfile.UTIL_DIR, dockerfile.UTIL_DIR, dockerfile.is_runtime_util),
+        (f"{stg_dir}/Dockerfile", "Dockerfile"),
+        (f"{stg_dir}/*{overlay.COMPOSE}", ""),
+        (app, f"{dockerfile.DATA_DIR}/{app}", is_data),
+        (app, app, lambda path: not is_data(path)),
+        (f"{stg_dir}/{app}", app, os.path.islink),
+        (snapshot_dir(build_args), datacache.SNAPSHOT_DIR),
+        (f"{build_args.stg_dir}/.env", ".env"),
+        (f"{build_args.entrypoint}.py", "entrypoint.py"),
+    ]
+
+
+def context_files(build_args) -> list:
+    """(path, arcname) of every file sent as the build context"""
+    if build_args.stream:
+        sources = context_sources(build_args)
+        patterns = docker_context.read_ignore("_docker/.dockerignore")
+    else:
+        sources = [(build_args.stg_dir, "")]
+        patterns = docker_context.read_ignore(f"{build_args.stg_dir}/.dockerignore")
+    return docker_context.collect(sources, patterns)
 
 
 def build(build_args) -> None:
     logging.info("Building docker image ...")
     dm = DockerManager()
-    # os.environ["DOCKER_BUILDKIT"] = "1"
     build_context = {
         "tag": build_args.tag,
-        "path": build_args.stg_dir,
+        "record_file": f"{build_args.build_dir}/.build_cache.json",
     }
-    code = dm.build(build_context)
+    if build_args.buildkit:
+        build_context["buildkit"] = {
+            "cache_dir": build_args.env.BUILD_CACHE_DIR,
+            "cache_mb": build_args.env.BUILD_CACHE_MB,
+            "builder": build_args.env.BUILDX_BUILDER,
+        }
+    files = context_files(build_args)
+    known = FM.known_hashes(build_args.stg_dir)
+    extra = {"buildargs": {}, "buildkit": build_args.buildkit}
+    build_context["digest"] = docker_context.digest(files, extra, known)
+    logging.debug(f"Context digest: {build_context['digest']}")
+
+    if build_args.stream:
+        build_context["fileobj"] = docker_context.stream(files)
+    else:
+        build_context["path"] = build_args.stg_dir
+    code = dm.build(build_context, {"force": build_args.clean})
     if code:
-        finish(None)
+        finish(None, 1)
+
+
+def analyze(build_args) -> None:
+    """Reports image layer sizes and the context's largest and accidental-looking
+    files, failing when the image exceeds the app's budget (IMAGE_BUDGET_MB)
+    """
+    report = size_report.context_report(context_files(build_args))
+    logging.info(f"Context: {size_report.mb(report['total']).strip()}, largest files:")
+    for arcname, size in report["largest"]:
+        logging.info(f"  {size_report.mb(size)}  {arcname}")
+    for arcname, size, _ in report["suspicious"]:
+        logging.warning(f"Accidental? {arcname} ({size_report.mb(size).strip()})")
+
+    dm = DockerManager()
+    logging.info("Image layers:")
+    for size, created_by in dm.layers(build_args.tag):
+        if size:
+            logging.info(f"  {size_report.mb(size)}  {created_by[:100]}")
+    total = dm.image_size(build_args.tag)
+    budget = size_report.budget_mb(build_args.env.IMAGE_BUDGET_MB, build_args.app)
+    logging.info(f"Image {build_args.tag}: {size_report.mb(total).strip()}")
+    if budget and total > budget * 2 ** 20:
+        logging.error(f"Image exceeds its {budget:.0f} MB budget")
+        finish(None, 1)
 
 
 def push(build_args) -> None:
     logging.info("Pushing docker image ...")
     dm = DockerManager()
-    dm.push(build_args.tag)
+    metadata = {"source": build_args.tag, "progress": build_args.progress}
+    code = dm.push(build_args.push_tags, metadata)
+    if code:
+        finish(None, 1)
 
 
 def enter(build_args) -> None:
@@ -140,13 +362,95 @@ def run(build_args) -> None:
     run_command(["docker-compose", "-f", compose_file, "up"])
 
 
+def pipeline_steps(build_args) -> list:
+    """Build steps selected by the build args, with the resources each needs/makes"""
+    Step = pipeline.Step
+    steps = [
+        Step(tag, outputs=("tag",)),
+        Step(prepare_stage, outputs=("stage",)),
+        Step(snapshot_data, ("stage",), ("snapshots",)) if build_args.build else None,
+        # The Dockerfile has a snapshot layer only if there are snapshots
+        Step(add_docker, ("stage", "snapshots"), ("compose", "dockerfile")),
+        Step(env_file, ("stage", "tag"), ("env",)),
+        Step(prepare_entrypoint, ("stage",), ("entrypoint",)),
+        Step(execute, ("stage", "env", "entrypoint"), foreground=True)
+        if build_args.execute
+        else None,
+        Step(build, ("tag", "stage", "dockerfile", "env", "entrypoint"), ("image",))
+        if build_args.build
+        else None,
+        Step(analyze, ("image",), ("checked",)) if build_args.build else None,
+        Step(push, ("tag", "image", "checked"), ("pushed",))
+        if build_args.push
+        else None,
+        Step(enter, ("image",), foreground=True) if build_args.interact else None,
+        Step(run, ("image", "compose", "env"), foreground=True)
+        if build_args.up
+        else None,
+    ]
+    return [step for step in steps if step]
+
+
+def run_app(build_args) -> None:
+    """Runs the selected steps, each as soon as the steps it depends on finish"""
+    steps = pipeline_steps(build_args)
+    timings_file = f"{build_args.build_dir}/.timings.json"
+    if build_args.plan:
+        timings = pipeline.load_timings(timings_file).get(build_args.app, {})
+        logging.info(f"Plan for {build_args.app}:\n{pipeline.plan(steps, timings)}")
+        return
+
+    with tracing.span(f"app {build_args.app}", app=build_args.app):
+        durations = pipeline.run(steps, build_args)
+    FM.create(build_args.build_dir)
+    pipeline.save_timings(timings_file, build_args.app, durations)
+    logging.debug(pipeline.plan(steps, durations))
+
+
+def for_app(build_args, app):
+    """Copies the build args, pointed at one app and its own staging directory"""
+    app_args = copy.copy(build_args)
+    app_args.app = app
+    app_args.stg_dir = f"{build_args.build_dir}/{app}"
+    return app_args
+
+
+def run_apps(build_args) -> bool:
+    """Runs several apps' pipelines side by side, then summarizes. True if all pass"""
+
+    def worker(app):
+        # Tags every log line emitted from this thread with the app name
+        logger.log_context.set(app)
+        start = time.time()
+        try:
+            run_app(for_app(build_args, app))
+            status = "ok"
+        except (Exception, SystemExit) as exc:
+            logging.error(f"Failed: {exc!r}")
+            status = "failed"
+        logger.log_context.set("")
+        return status, time.time() - start
+
+    workers = min(build_args.jobs, len(build_args.app))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        results = dict(zip(build_args.app, pool.map(worker, build_args.app)))
+
+    width = max(len(app) for app in results)
+    summary = [f"{'app': <{width}}  status  duration"]
+    for app, (status, duration) in results.items():
+        summary.append(f"{app: <{width}}  {status: <6}  {duration:7.1f}s")
+    logging.info("Summary:\n" + "\n".join(summary))
+    return all(status == "ok" for status, _ in results.values())
+
+
 if __name__ == "__main__":
     # Apps will be any directory without a leading underscore
     apps = [ddir[:-1] for ddir in glob.glob("[a-z]*/")]
 
     # Handle build arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument("app", type=str, choices=apps, help=f"Choose app from {apps}")
+    parser.add_argument("app", type=str, nargs="*", help=f"Choose apps from {apps}")
+    parser.add_argument("-a", "--all", action="store_true", help="Use all apps")
     parser.add_argument(
         "--build_dir", type=str, default="_build", help=f"Choose build dir (_build)"
     )
@@ -157,18 +461,59 @@ if __name__ == "__main__":
         help=f"Choose entrypoint (entrypoint)",
     )
     parser.add_argument("-b", "--build", action="store_true", help="Build docker image")
+    parser.add_argument(
+        "-c", "--clean", action="store_true", help="Clean staging before build"
+    )
     parser.add_argument("-d", "--dev", action="store_true", help="Dev build")
     parser.add_argument(
         "-i", "--interact", action="store_true", help="Enter docker image"
     )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=4, help="Apps to run in parallel (4)"
+    )
+    parser.add_argument(
+        "-k", "--buildkit", action="store_true", help="BuildKit with local cache"
+    )
     parser.add_argument("-p", "--push", action="store_true", help="Push image online")
+    parser.add_argument(
+        "--latest", action="store_true", help="Also push the 'latest' tag"
+    )
+    parser.add_argument(
+        "--registries", nargs="+", default=[], help="Also push to these registries"
+    )
+    parser.add_argument(
+        "--progress", choices=["bar", "json"], default="bar", help="Push progress (bar)"
+    )
+    parser.add_argument(
+        "--plan", action="store_true", help="Show step graph and critical path"
+    )
     parser.add_argument("-q", "--quiet", action="store_true", help="No info output")
     parser.add_argument("-r", "--release", nargs="?", default="", help=f"Release (app)")
+    parser.add_argument(
+        "-s", "--stream", action="store_true", help="Stream context from source"
+    )
     parser.add_argument("-t", "--tag", nargs="?", default="", help="Docker image tag")
+    parser.add_argument(
+        "--trace", type=str, default="", help="Save a Chrome trace to this file"
+    )
     parser.add_argument("-u", "--up", action="store_true", help="Run after build")
     parser.add_argument("-v", "--verbose", action="store_true", help="Debugging output")
+    parser.add_argument(
+        "-w", "--watch", action="store_true", help="With -x, re-stage source edits"
+    )
     parser.add_argument("-x", "--execute", action="store_true", help="Run (no docker)")
     args = parser.parse_args()
+    if args.all:
+        args.app = sorted(apps)
+    for app in args.app:
+        if app not in apps:
+            parser.error(f"invalid app: '{app}' (choose from {apps})")
+    if not args.app:
+        parser.error("choose at least one app, or use --all")
+    if len(args.app) > 1 and (args.execute or args.interact or args.up):
+        parser.error("-x, -i and -u run in the foreground, use a single app")
+    if args.watch and not args.execute:
+        parser.error("--watch keeps a -x run's staging up to date, add -x")
 
     # NOTE This has issues with timing of imports. We probably need to add some more
     # clever way to adjust the logging levels of local modueles
@@ -182,28 +527,18 @@ if __name__ == "__main__":
 
     args.env = environment.init("ENV")
 
-    # Point staging directory to app-specific directory
-    args.stg_dir = f"{args.build_dir}/{args.app}"
-
     logging.debug("---Build args:")
     logging.debug(vars(args))
 
-    # Ordered series of operations to run
-    steps = [
-        tag,
-        prepare_stage,
-        add_docker,
-        env_file,
-        prepare_entrypoint,
-        execute if args.execute else None,
-        build if args.build else None,
-        push if args.push else None,
-        enter if args.interact else None,
-        run if args.up else None,
-    ]
-
-    # Run build methods
-    for step in steps:
-        if not step:
-            continue
-        step(args)
+    if args.trace:
+        tracing.start()
+    try:
+        if len(args.app) > 1:
+            sys.exit(0 if run_apps(args) else 1)
+
+        # A single app runs on this thread, so interactive steps keep the terminal
+        run_app(for_app(args, args.app[0]))
+    finally:
+        if args.trace:
+            tracing.save(args.trace)
+            logging.info(f"Trace saved to {args.trace} (open in ui.perfetto.dev)")
@@ -9,6 +9,17 @@ logging = logger.fancy_logger("entrypoint")
 logging.info(f"Loading descriptor from {os.environ['APP']}/descriptor.py")
 desc_file = importlib.import_module(f"{os.environ['APP']}.descriptor")
 
+# Data modules start from the snapshots made by build.py when there are any,
+# otherwise (or when they're stale) their load() runs as usual
+try:
+    from _util import datacache
+
+    for module_name in datacache.app_modules(os.environ["APP"]):
+        if datacache.install(module_name):
+            logging.info(f"Using the {module_name} snapshot")
+except ImportError:
+    logging.debug("No _util.datacache, data modules will run load()")
+
 # This generates the app from the descriptor
 app_def = bento.Bento(desc_file.descriptor)
 if app_def.valid:
@@ -1,10 +1,15 @@
 import pandas as pd
 
+from _util import datacache
 
+FILENAME = "housing/zillow_housing_2020.csv"
+
+
+# Parsed once, then read from a snapshot until the CSV or this module changes
+@datacache.cached(FILENAME)
 def load():
-    filename = "housing/zillow_housing_2020.csv"
-    df = pd.read_csv(filename)
-    df.loc[:, "fips"] = df.fips.astype(str).str.zfill(2)
+    df = pd.read_csv(FILENAME)
+    df["fips"] = df.fips.astype(str).str.zfill(2)
     data = {
         "df": df,
         "keys": ["state", "fips"],